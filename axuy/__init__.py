@@ -23,13 +23,25 @@ All classes and helper functions are exposed at the package level.
 
 Some superclasses may define abstract methods which must be overridden
 in derived classes.  Subclasses only document newly introduced attributes.
+
+The dedicated server in axuy.server is run as a module
+and thus not imported here.
 """
 
-from .control import *
-from .display import *
+from .aio import *
 from .misc import *
 from .peer import *
 from .pico import *
+from .profiler import *
+from .wire import *
+
+__all__ = (misc.__all__ + pico.__all__ + wire.__all__
+           + profiler.__all__ + peer.__all__ + aio.__all__)
 
-__all__ = (misc.__all__ + pico.__all__ + peer.__all__
-           + display.__all__ + control.__all__)
+try:    # the graphical front-end needs GLFW and moderngl
+    from .control import *
+    from .display import *
+except ImportError:
+    pass
+else:
+    __all__ += display.__all__ + control.__all__
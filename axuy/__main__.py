@@ -19,14 +19,20 @@
 __doc__ = 'Axuy main loop'
 __all__ = ['main']
 
+from .aio import AsyncPeer
 from .control import Control, CtlConfig
 
 
+class AsyncControl(AsyncPeer, Control):
+    """User control with networking on an asyncio event loop."""
+
+
 def main():
     """Parse arguments and start main loop."""
     config = CtlConfig()
     config.parse()
-    with Control(config) as peer: peer.run()
+    backend = AsyncControl if config.backend == 'asyncio' else Control
+    with backend(config) as peer: peer.run()
 
 
 if __name__ == '__main__': main()
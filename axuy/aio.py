@@ -0,0 +1,170 @@
+# asyncio networking
+# Copyright (C) 2019  Nguyễn Gia Phong
+#
+# This file is part of Axuy
+#
+# Axuy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Axuy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Axuy.  If not, see <https://www.gnu.org/licenses/>.
+
+__doc__ = 'Axuy peer on an asyncio event loop'
+__all__ = ['AsyncPeer']
+
+from asyncio import (DatagramProtocol, new_event_loop,
+                     open_connection, sleep, start_server)
+from typing import Iterator, List, Optional, Tuple
+
+from .peer import Peer
+from .pico import Pico
+from .wire import State
+
+
+class Inbox(DatagramProtocol):
+    """Protocol passing received (data, addr) to the given callback."""
+
+    def __init__(self, callback) -> None:
+        self.callback = callback
+
+    def datagram_received(self, data, addr) -> None:
+        self.callback(data, addr)
+
+
+class AsyncPeer(Peer):
+    """Axuy peer exchanging packets on an asyncio event loop
+    instead of the serve and pull threads.
+
+    The loop is either polled without blocking by the main loop
+    in run or shared by peers running concurrently as coroutines
+    from arun, in which case they must be constructed before
+    the loop is started.
+
+    Parameters
+    ----------
+    config : PeerConfig
+        Networking configurations.
+    loop : asyncio.AbstractEventLoop, optional
+        Event loop, possibly shared with other peers
+        (fallback: a new event loop owned by this peer).
+
+    Attributes
+    ----------
+    loop : asyncio.AbstractEventLoop
+        Event loop handling the sockets.
+    owns_loop : bool
+        Whether the event loop is to be closed with the peer.
+    transport : asyncio.DatagramTransport
+        Transport for exchanging instantaneous states with other peers.
+    mtransport : Optional[asyncio.DatagramTransport]
+        Transport receiving states sent to the multicast group.
+    server : asyncio.AbstractServer
+        TCP server initiating other peers.
+    """
+
+    def __init__(self, config, loop=None):
+        self.owns_loop = loop is None
+        self.loop = new_event_loop() if loop is None else loop
+        super().__init__(config)
+        self.transport = self.mtransport = None
+        try:
+            self.transport = self.listen(self.sock)
+            if self.msock is not None:
+                self.mtransport = self.listen(self.msock)
+            self.server = self.loop.run_until_complete(start_server(
+                self.greet, *self.addr, reuse_address=True))
+        except BaseException:
+            # Leave no socket of a half-built peer on a shared loop.
+            for transport in self.transport, self.mtransport:
+                if transport is not None: transport.close()
+            self.sock.close()
+            if self.msock is not None: self.msock.close()
+            raise
+        print('Axuy is listening at {}:{}'.format(*self.addr))
+
+    def listen(self, sock):
+        """Return the transport of the given UDP socket,
+        which decodes received packets into the inbox.
+        """
+        transport, protocol = self.loop.run_until_complete(
+            self.loop.create_datagram_endpoint(lambda: Inbox(self.receive),
+                                               sock=sock))
+        return transport
+
+    @property
+    def ready(self) -> Iterator[Tuple[Tuple[str, int], State,
+                                      Optional[Pico]]]:
+        """Iterator of (addr, state, pico) that can be used without
+        waiting, where addr is the address of the peer the state
+        originates from and pico is None unless addr is new.
+        """
+        if not self.loop.is_running(): self.poll()
+        yield from self.inbox.take()
+
+    def poll(self) -> None:
+        """Run the event loop until no more packets can be received
+        without waiting.
+        """
+        while True:
+            arrived = self.inbox.arrived
+            # Stopping right away makes the loop process
+            # ready I/O events once without blocking.
+            self.loop.call_soon(self.loop.stop)
+            self.loop.run_forever()
+            if self.inbox.arrived == arrived: break
+
+    def join(self, seeder) -> Tuple[List[int], List[Tuple[str, int]],
+                                    Tuple[str, int]]:
+        """Return the map ID and addresses of connected peers
+        received from the seeder, along with its resolved address.
+        """
+        async def handshake():
+            # An empty host is the local one, as with socket.connect.
+            host, port = seeder
+            reader, writer = await open_connection(host or '0.0.0.0', port)
+            data = await reader.read()
+            address = writer.get_extra_info('peername')[:2]
+            writer.close()
+            return (*self.unshake(data), address)
+
+        return self.loop.run_until_complete(handshake())
+
+    async def greet(self, reader, writer) -> None:
+        """Send the map ID and addresses of connected peers
+        to a new peer.
+        """
+        writer.write(self.handshake())
+        await writer.drain()
+        writer.close()
+
+    def send(self, data, address) -> None:
+        """Send data to the peer at the given address."""
+        self.transport.sendto(data, address)
+
+    def run(self) -> None:
+        """Start main loop."""
+        while self.is_running: self.update()
+
+    async def arun(self) -> None:
+        """Start main loop as a coroutine, yielding to other tasks
+        on the event loop after each update.
+        """
+        while self.is_running:
+            self.update()
+            await sleep(0)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.close()
+        self.transport.close()
+        if self.mtransport is not None: self.mtransport.close()
+        if not self.loop.is_running():
+            self.loop.run_until_complete(self.server.wait_closed())
+            if self.owns_loop: self.loop.close()
+        super().__exit__(exc_type, exc_value, traceback)
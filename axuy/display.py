@@ -23,7 +23,6 @@ from abc import abstractmethod
 from collections import deque
 from math import degrees, log2, radians
 from random import randint
-from statistics import mean
 from warnings import warn
 
 import glfw
@@ -32,9 +31,9 @@ import numpy as np
 from PIL import Image
 from pyrr import matrix44
 
-from .misc import abspath, color, mirror
+from .misc import COLORS, OFFSETS, abspath, color, mirror
 from .peer import Peer, PeerConfig
-from .pico import OCTOVERTICES, SHARD_LIFE, TETRAVERTICES
+from .pico import OCTOVERTICES, RPICO, RSHARD, SHARD_LIFE, TETRAVERTICES
 
 CONWAY = 1.303577269034
 ABRTN_MAX = 0.42069
@@ -43,12 +42,23 @@ QUAD = np.float32([-1, -1, 1, -1, -1, 1, -1, 1, 1, -1, 1, 1])
 TETRAINDECIES = np.int32([0, 1, 2, 3, 1, 2, 0, 3, 2, 0, 3, 1])
 OCTOINDECIES = np.int32([0, 1, 2, 0, 1, 3, 4, 0, 2, 4, 0, 3,
                          2, 1, 5, 3, 1, 5, 2, 5, 4, 3, 5, 4])
+# Width of the largest blur table and number of levels blurred
+# in the downsample chain of each bloom quality
+BLOOM = {'off': (0, 0), 'low': (128, 1), 'medium': (256, 1), 'high': (512, 3)}
+RESIZE_DELAY = 0.25     # seconds without resizing to reallocate buffers
+# Dynamic resolution scaling: range and step of the scale of the rendered
+# scene to the screen, and seconds of frames averaged to adjust it
+MIN_SCALE, SCALE_STEP, SCALE_PERIOD = 0.5, 0.125, 0.5
+
+# Per-instance position, rotation and color of images of picos and shards
+INSTANCE = np.dtype([('pos', 'f4', 3), ('rot', 'f4', 9), ('color', 'f4', 3)])
 
 with open(abspath('shaders/map.vert')) as f: MAP_VERTEX = f.read()
 with open(abspath('shaders/map.frag')) as f: MAP_FRAGMENT = f.read()
 with open(abspath('shaders/pico.vert')) as f: PICO_VERTEX = f.read()
 with open(abspath('shaders/pico.geom')) as f: PICO_GEOMETRY = f.read()
 with open(abspath('shaders/pico.frag')) as f: PICO_FRAGMENT = f.read()
+with open(abspath('shaders/instance.vert')) as f: INSTANCE_VERTEX = f.read()
 
 with open(abspath('shaders/tex.vert')) as f: TEX_VERTEX = f.read()
 with open(abspath('shaders/sat.frag')) as f: SAT_FRAGMENT = f.read()
@@ -56,6 +66,7 @@ with open(abspath('shaders/gaussh.vert')) as f: GAUSSH_VERTEX = f.read()
 with open(abspath('shaders/gaussv.vert')) as f: GAUSSV_VERTEX = f.read()
 with open(abspath('shaders/gauss.frag')) as f: GAUSS_FRAGMENT = f.read()
 with open(abspath('shaders/comb.frag')) as f: COMBINE_FRAGMENT = f.read()
+with open(abspath('shaders/copy.frag')) as f: COPY_FRAGMENT = f.read()
 
 
 class DispConfig(PeerConfig):
@@ -69,6 +80,14 @@ class DispConfig(PeerConfig):
         Vertical synchronization.
     zmlvl : float
         Zoom level.
+    instancing : bool
+        Whether to draw all visible images of picos and shards
+        in one call each.
+    bloom : str
+        Quality of the bloom effect, one of BLOOM.
+    frame_time : float
+        Target frame time in milliseconds kept by dynamic resolution
+        scaling, 0 to always render at full resolution.
     """
 
     def __init__(self) -> None:
@@ -84,6 +103,21 @@ class DispConfig(PeerConfig):
         self.options.add_argument(
             '--no-vsync', action='store_false', dest='vsync',
             help='disable vertical synchronization')
+        self.options.add_argument(
+            '--instancing', action='store_true', default=None,
+            help='enable instanced rendering (fallback: {})'.format(
+                self.instancing))
+        self.options.add_argument(
+            '--no-instancing', action='store_false', dest='instancing',
+            help='draw picos and shards one by one')
+        self.options.add_argument(
+            '--bloom', choices=BLOOM,
+            help='quality of the bloom effect (fallback: {})'.format(
+                self.bloom))
+        self.options.add_argument(
+            '--frame-time', type=float, metavar='MS',
+            help='target frame time kept by dynamic resolution scaling,'
+            ' 0 to disable (fallback: {})'.format(self.frame_time))
         self.options.add_argument(
             '--fov', type=float, metavar='DEGREES',
             help='horizontal field of view (fallback: {:})'.format(
@@ -114,12 +148,16 @@ class DispConfig(PeerConfig):
         self.size = (self.config.getint('Graphics', 'Screen width'),
                      self.config.getint('Graphics', 'Screen height'))
         self.vsync = self.config.getboolean('Graphics', 'V-sync')
+        self.instancing = self.config.getboolean('Graphics', 'Instancing')
+        self.bloom = self.config.get('Graphics', 'Bloom')
+        self.frame_time = self.config.getfloat('Graphics', 'Frame time')
         self.fov = self.config.getfloat('Graphics', 'FOV')
 
     def read(self, arguments):
         """Read and parse a argparse.ArgumentParser.Namespace."""
         PeerConfig.read(self, arguments)
-        for option in 'size', 'vsync', 'fov':
+        for option in ('size', 'vsync', 'instancing', 'bloom',
+                       'frame_time', 'fov'):
             value = getattr(arguments, option)
             if value is not None: setattr(self, option, value)
 
@@ -154,22 +192,59 @@ class Display(Peer):
         Vertex data of picos.
     sva : moderngl.VertexArray
         Vertex data of shards.
+    instancing : bool
+        Whether to draw all visible images of picos and shards in one
+        call each, instead of drawing picos and shards one by one
+        with all of their images.
+    iprog : moderngl.Program
+        Processed executable code in GLSL for instanced rendering
+        of images of picos and their shards.
+    pinst, sinst : moderngl.Buffer
+        Per-instance data of images of picos and shards,
+        of dtype INSTANCE.
+    ipva, isva : moderngl.VertexArray
+        Vertex and per-instance data of picos and shards.
     pfilter : moderngl.VertexArray
         Vertex data for filtering highly saturated colors.
     gaussh, gaussv : moderngl.Program
         Processed executable code in GLSL for Gaussian blur.
     gausshva, gaussvva : moderngl.VertexArray
         Vertex data for Gaussian blur.
+    copy : moderngl.VertexArray
+        Vertex data for copying textures, scaling them if needed.
     edge : moderngl.Program
         Processed executable code in GLSL for final combination
         of the bloom effect with additional chromatic aberration
         and barrel distortion.
     combine : moderngl.VertexArray
         Vertex data for final combination of the bloom effect.
-    fb, ping, pong : moderngl.Framebuffer
-        Frame buffers for bloom-effect post-processing.
-    fpses : Deque[float]
-        FPS during the last 5 seconds to display the average.
+    bloom : str
+        Quality of the bloom effect, one of BLOOM.
+    fb : moderngl.Framebuffer
+        Frame buffer the scene is rendered to.
+    levels : List[Tuple[moderngl.Framebuffer, moderngl.Framebuffer]]
+        Pairs of frame buffers for blurring each level of the bloom
+        effect's downsample chain, halving in size at each level.
+    black : moderngl.Texture
+        Texture in place of the bloom effect when it is off.
+    resized : Optional[Tuple[int, int, float]]
+        Screen size and time of the last resize not yet reflected
+        in the frame buffers.
+    size : Tuple[int, int]
+        Screen size the frame buffers are allocated for.
+    target : float
+        Target frame time in seconds, 0 for a fixed resolution.
+    scale : float
+        Scale of the resolution the scene is rendered at
+        to the screen's, between MIN_SCALE and 1.
+    sampled : Tuple[float, int]
+        Time the current frame time sample started
+        and number of frames in it.
+    frames : Deque[float]
+        Durations of frames during the last 5 seconds
+        to display the average FPS.
+    span : float
+        Total duration of these frames.
     """
 
     def __init__(self, config):
@@ -191,7 +266,7 @@ class Display(Peer):
         if not self.window:
             glfw.terminate()
             raise RuntimeError('Failed to create GLFW window')
-        self.fpses = deque()
+        self.frames, self.span = deque(), 0.0
 
         # Window's rendering and event-handling configuration
         glfw.set_window_icon(self.window, 1, Image.open(abspath('icon.png')))
@@ -221,6 +296,19 @@ class Display(Peer):
         self.pva = context.vertex_array(self.prog, pvb, pib)
         self.sva = context.vertex_array(self.prog, svb, sib)
 
+        # Instanced counterparts, with images culled beforehand
+        # instead of all emitted by the geometry shader
+        self.instancing = config.instancing
+        self.iprog = context.program(vertex_shader=INSTANCE_VERTEX,
+                                     fragment_shader=PICO_FRAGMENT)
+        self.pinst = context.buffer(reserve=INSTANCE.itemsize, dynamic=True)
+        self.sinst = context.buffer(reserve=INSTANCE.itemsize, dynamic=True)
+        instance = '3f 9f 3f/i', 'in_pos', 'in_rot', 'in_color'
+        self.ipva = context.vertex_array(self.iprog, [
+            pvb[0], (self.pinst, *instance)], pib)
+        self.isva = context.vertex_array(self.iprog, [
+            svb[0], (self.sinst, *instance)], sib)
+
         quad_buffer = context.buffer(QUAD)
         self.pfilter = context.simple_vertex_array(
             context.program(vertex_shader=TEX_VERTEX,
@@ -228,12 +316,10 @@ class Display(Peer):
             quad_buffer, 'in_vert')
         self.gaussh = context.program(vertex_shader=GAUSSH_VERTEX,
                                       fragment_shader=GAUSS_FRAGMENT)
-        self.gaussh['width'].value = 256
         self.gausshva = context.simple_vertex_array(
             self.gaussh, quad_buffer, 'in_vert')
         self.gaussv = context.program(vertex_shader=GAUSSV_VERTEX,
                                       fragment_shader=GAUSS_FRAGMENT)
-        self.gaussv['height'].value = 256 * height / width
         self.gaussvva = context.simple_vertex_array(
             self.gaussv, quad_buffer, 'in_vert')
         self.edge = context.program(vertex_shader=TEX_VERTEX,
@@ -242,31 +328,121 @@ class Display(Peer):
         self.edge['tex'].value = 1
         self.combine = context.simple_vertex_array(
             self.edge, quad_buffer, 'in_vert')
+        self.copy = context.simple_vertex_array(
+            context.program(vertex_shader=TEX_VERTEX,
+                            fragment_shader=COPY_FRAGMENT),
+            quad_buffer, 'in_vert')
 
-        size, table = (width, height), (256, height * 256 // width)
-        self.fb = context.framebuffer(context.texture(size, 4),
-                                      context.depth_renderbuffer(size))
-        self.fb.color_attachments[0].use(1)
-        self.ping = context.framebuffer(context.texture(table, 3))
-        self.pong = context.framebuffer(context.texture(table, 3))
+        self.bloom, self.fb, self.levels = config.bloom, None, []
+        self.black = context.texture((1, 1), 3, bytes(3))
+        self.resized, self.sampled = None, (self.get_time(), 0)
+        self.target, self.scale = config.frame_time / 1000, 1.0
+        self.allocate(width, height)
+
+    def allocate(self, width, height) -> None:
+        """Allocate frame buffers for the given screen size,
+        keeping those already of the right sizes.
+
+        The scene is rendered at the resolution scale, to be
+        upscaled to the screen when combined.
+        """
+        context, self.size = self.context, (width, height)
+        size = (max(round(width*self.scale), 1),
+                max(round(height*self.scale), 1))
+        if self.fb is None or self.fb.size != size:
+            if self.fb is not None:
+                self.fb.depth_attachment.release()
+                self.fb.color_attachments[0].release()
+                self.fb.release()
+            self.fb = context.framebuffer(context.texture(size, 4),
+                                          context.depth_renderbuffer(size))
+            self.fb.color_attachments[0].use(1)
+
+        table, levels = BLOOM[self.bloom]
+        tables = [(max(table >> i, 1), max(height*table//width >> i, 1))
+                  for i in range(levels)]
+        if [ping.size for ping, pong in self.levels] == tables: return
+        for fbs in self.levels:
+            for fb in fbs:
+                fb.color_attachments[0].release()
+                fb.release()
+        self.levels = [(context.framebuffer(context.texture(table, 3)),
+                        context.framebuffer(context.texture(table, 3)))
+                       for table in tables]
 
     def resize(self, window, width, height):
-        """Update viewport on resize."""
-        context = self.context
-        context.viewport = 0, 0, width, height
-        self.gaussv['height'].value = 256 * height / width
-
-        self.fb.depth_attachment.release()
-        for fb in (self.fb, self.ping, self.pong):
-            for texture in fb.color_attachments: texture.release()
-            fb.release()
-
-        size, table = (width, height), (256, height * 256 // width)
-        self.fb = context.framebuffer(context.texture(size, 4),
-                                      context.depth_renderbuffer(size))
-        self.fb.color_attachments[0].use(1)
-        self.ping = context.framebuffer(context.texture(table, 3))
-        self.pong = context.framebuffer(context.texture(table, 3))
+        """Update viewport on resize and defer reallocation
+        of frame buffers until resizing stops.
+        """
+        if not width or not height: return     # minimized
+        self.context.viewport = 0, 0, width, height
+        self.resized = width, height, self.get_time()
+
+    def rescale(self) -> None:
+        """Step the resolution scale toward the target frame time,
+        judging by the mean frame time over each SCALE_PERIOD.
+
+        The scale is only stepped up if the frame time predicted
+        from the number of pixels would still meet the target.
+        """
+        start, count = self.sampled[0], self.sampled[1] + 1
+        elapsed = self.last_time - start
+        if elapsed < SCALE_PERIOD:
+            self.sampled = start, count
+            return
+        self.sampled = self.last_time, 0
+        if not self.target: return
+        frame = elapsed / count
+        if frame > self.target:
+            scale = max(self.scale-SCALE_STEP, MIN_SCALE)
+        elif frame * ((self.scale+SCALE_STEP)/self.scale)**2 < self.target:
+            scale = min(self.scale+SCALE_STEP, 1.0)
+        else:
+            return
+        if scale != self.scale:
+            self.scale = scale
+            self.allocate(*self.size)
+
+    def postprocess(self) -> None:
+        """Blur highly saturated colors of the rendered scene
+        through the bloom downsample chain and bind the sum
+        of its levels as the texture of the bloom effect.
+        """
+        if not self.levels:
+            self.black.use()
+            return
+        self.fb.color_attachments[0].use()
+        for i, (ping, pong) in enumerate(self.levels):
+            ping.use()
+            ping.clear()
+            # Filter the scene or downsample the previous level
+            (self.copy if i else self.pfilter).render(moderngl.TRIANGLES)
+            ping.color_attachments[0].use()
+
+            # Gaussian blur
+            width, height = ping.size
+            self.gaussh['width'].value = width
+            pong.use()
+            pong.clear()
+            self.gausshva.render(moderngl.TRIANGLES)
+            pong.color_attachments[0].use()
+            self.gaussv['height'].value = height
+            ping.use()
+            ping.clear()
+            self.gaussvva.render(moderngl.TRIANGLES)
+            ping.color_attachments[0].use()
+
+        # Add lower levels up to the first
+        first = self.levels[0][0]
+        if len(self.levels) > 1:
+            first.use()
+            self.context.enable(moderngl.BLEND)
+            self.context.blend_func = moderngl.ONE, moderngl.ONE
+            for ping, pong in self.levels[1:]:
+                ping.color_attachments[0].use()
+                self.copy.render(moderngl.TRIANGLES)
+            self.context.disable(moderngl.BLEND)
+        first.color_attachments[0].use()
 
     @property
     def width(self) -> int:
@@ -285,8 +461,10 @@ class Display(Peer):
 
     @property
     def pos(self) -> np.float32:
-        """Camera position in a NumPy array."""
-        return self.camera.pos
+        """Camera position in a NumPy array, interpolated
+        between the last two simulated states.
+        """
+        return self.interpolate(self.camera)
 
     @property
     def postr(self) -> str:
@@ -326,34 +504,96 @@ class Display(Peer):
     @property
     def fpstr(self) -> str:
         """Pretty string for displaying average FPS."""
-        # Average over 5 seconds, like how glxgears do it, but less efficient
-        while len(self.fpses) > mean(self.fpses) * 5 > 0: self.fpses.pop()
-        return '{} fps'.format(round(mean(self.fpses)))
+        # Average over 5 seconds, like how glxgears do it
+        while self.span > 5 and len(self.frames) > 1:
+            self.span -= self.frames.popleft()
+        if not self.span: return '0 fps'
+        return '{} fps'.format(round(len(self.frames) / self.span))
 
     def get_time(self) -> float:
         """Return the current time in seconds."""
         return glfw.get_time()
 
-    def prender(self, obj, va, col, bright):
-        """Render the obj and its images in bounded 3D space."""
+    def prender(self, pos, rot, va, col, bright):
+        """Render an object of the given position and rotation
+        and its images in bounded 3D space.
+        """
         self.prog['rot'].write(
-            matrix44.create_from_matrix33(obj.rot, dtype=np.float32))
-        self.prog['pos'].write(obj.pos)
+            matrix44.create_from_matrix33(rot, dtype=np.float32))
+        self.prog['pos'].write(np.asarray(pos, dtype=np.float32))
         self.prog['color'].write(color(col, bright))
         va.render(moderngl.TRIANGLES)
 
     def render_pico(self, pico):
         """Render pico and its images in bounded 3D space."""
-        self.prender(pico, self.pva, self.colors[pico.addr], pico.health)
-
-    def render_shard(self, shard):
-        """Render shard and its images in bounded 3D space."""
-        self.prender(shard, self.sva,
+        self.prender(self.interpolate(pico), pico.rot, self.pva,
+                     self.colors[pico.addr], pico.health)
+
+    def render_shard(self, shard, pos=None):
+        """Render shard and its images in bounded 3D space,
+        at the given position if any.
+        """
+        self.prender(shard.pos if pos is None else pos, shard.rot, self.sva,
                      self.colors[shard.addr], shard.power/SHARD_LIFE)
 
-    def add_pico(self, address):
-        """Add pico from given address."""
-        Peer.add_pico(self, address)
+    @staticmethod
+    def cull(positions, radius, planes):
+        """Return indices of objects at the given positions whose
+        images may be visible within the frustum of the given planes,
+        along with positions of those images.
+
+        Objects are bounded by spheres of the given radius, and planes
+        are of shape (6, 4) with normals pointing inwards.
+        """
+        images = (np.reshape(positions, (-1, 1, 3)) + OFFSETS).reshape(-1, 3)
+        distances = images @ planes[:, :3].T + planes[:, 3]
+        visible = (distances >= -radius).all(axis=1)
+        return np.flatnonzero(visible) // len(OFFSETS), images[visible]
+
+    def render_instances(self, va, buffer, positions, rotations, colors,
+                         radius, planes):
+        """Render visible images of objects of the given positions,
+        rotations and colors in bounded 3D space in one call,
+        through the vertex array va of the instance buffer.
+        """
+        indices, images = self.cull(positions, radius, planes)
+        instances = np.empty(len(images), dtype=INSTANCE)
+        if not len(instances): return
+        instances['pos'] = images
+        instances['rot'] = np.reshape(rotations, (-1, 9))[indices]
+        instances['color'] = np.reshape(colors, (-1, 3))[indices]
+        if instances.nbytes > buffer.size: buffer.orphan(instances.nbytes)
+        buffer.write(instances)
+        va.render(moderngl.TRIANGLES, instances=len(instances))
+
+    def render_picos(self, planes):
+        """Render visible images of picos other than the camera
+        in one call.
+        """
+        picos = [pico for pico in self.picos.values()
+                 if pico is not self.camera]
+        self.render_instances(
+            self.ipva, self.pinst,
+            [self.interpolate(pico) for pico in picos],
+            [pico.rot for pico in picos],
+            [color(self.colors[pico.addr], pico.health) for pico in picos],
+            RPICO, planes)
+
+    def render_shards(self, positions, planes):
+        """Render visible images of shards at the given positions
+        in one call.
+        """
+        palette = np.float32([COLORS[self.colors.get(address, 0)]
+                              for address in self.shards.owners])
+        brightness = (self.shards.power/SHARD_LIFE + 1) * 0.5
+        self.render_instances(
+            self.isva, self.sinst, positions, self.shards.rot,
+            palette[self.shards.owner] * brightness[:, np.newaxis],
+            RSHARD, planes)
+
+    def add_pico(self, address, pico=None):
+        """Add pico from given address, or the given one if any."""
+        Peer.add_pico(self, address, pico)
         self.colors[address] = randint(0, 5)
 
     def render(self) -> None:
@@ -362,67 +602,83 @@ class Display(Peer):
         projection = matrix44.create_perspective_projection(
             self.fov, self.width/self.height, 3E-3, visibility,
             dtype=np.float32)
+        pos = self.pos
         view = matrix44.create_look_at(
-            self.pos, self.pos+self.forward, self.upward, dtype=np.float32)
+            pos, pos+self.forward, self.upward, dtype=np.float32)
         vp = view @ projection
 
         # Render map
-        self.maprog['visibility'].value = visibility
-        self.maprog['mvp'].write(vp)
-        self.mapva.render(moderngl.TRIANGLES)
+        with self.profiler.measure('map'):
+            self.maprog['visibility'].value = visibility
+            self.maprog['mvp'].write(vp)
+            self.mapva.render(moderngl.TRIANGLES)
 
         # Render picos and shards
-        self.prog['visibility'].value = visibility
-        self.prog['camera'].write(self.pos)
-        self.prog['vp'].write(vp)
-        for pico in self.picos.values():
-            for shard in pico.shards.values(): self.render_shard(shard)
-            if pico is not self.camera: self.render_pico(pico)
+        with self.profiler.measure('picos'):
+            prog = self.iprog if self.instancing else self.prog
+            prog['visibility'].value = visibility
+            prog['camera'].write(np.asarray(pos, dtype=np.float32))
+            prog['vp'].write(vp)
+            positions = self.interpolate_shards()
+            if self.instancing:
+                # Frustum planes of row vectors transformed by vp,
+                # the farthest of which is at the visibility distance
+                planes = np.stack([vp[:, 3]+vp[:, 0], vp[:, 3]-vp[:, 0],
+                                   vp[:, 3]+vp[:, 1], vp[:, 3]-vp[:, 1],
+                                   vp[:, 3]+vp[:, 2], vp[:, 3]-vp[:, 2]])
+                planes /= np.linalg.norm(planes[:, :3], axis=1, keepdims=True)
+                self.render_shards(positions, planes)
+                self.render_picos(planes)
+                return
+            for shard, position in zip(self.shards, positions):
+                self.render_shard(shard, position)
+            for pico in self.picos.values():
+                if pico is not self.camera: self.render_pico(pico)
 
     def update(self) -> None:
         """Update and render the map."""
-        # Update states
+        # Update states, which may not advance the simulation,
+        # while handling window events every frame.
+        glfw.poll_events()
         Peer.update(self)
-        self.fpses.appendleft(self.fps)
+        if self.frame > 0:
+            self.frames.append(self.frame)
+            self.span += self.frame
+
+        # Reallocate frame buffers once resizing has stopped,
+        # stretching the old ones to the window in the meantime
+        if (self.resized is not None
+                and self.last_time-self.resized[-1] >= RESIZE_DELAY):
+            self.allocate(*self.resized[:2])
+            self.resized = None
+        self.rescale()
 
         # Render to framebuffer
         self.fb.use()
         self.fb.clear()
         self.render()
-        self.fb.color_attachments[0].use()
-        self.ping.use()
-        self.ping.clear()
-        self.pfilter.render(moderngl.TRIANGLES)
-        self.ping.color_attachments[0].use()
-
-        # Gaussian blur
-        self.pong.use()
-        self.pong.clear()
-        self.gausshva.render(moderngl.TRIANGLES)
-        self.pong.color_attachments[0].use()
-        self.ping.use()
-        self.ping.clear()
-        self.gaussvva.render(moderngl.TRIANGLES)
-        self.ping.color_attachments[0].use()
+        with self.profiler.measure('bloom'): self.postprocess()
 
         # Combine for glow effect, chromatic aberration and barrel distortion
-        self.context.screen.use()
-        self.context.clear()
-        if self.camera.dead:
-            abrtn = ABRTN_MAX
-        else:
-            abrtn = min(ABRTN_MAX, (self.fov*self.health) ** -CONWAY)
-        self.edge['abrtn'].value = abrtn
-        self.edge['zoom'].value = (self.zmlvl + 1.0) / 100
-        self.combine.render(moderngl.TRIANGLES)
-        glfw.swap_buffers(self.window)
+        with self.profiler.measure('combine'):
+            self.context.screen.use()
+            self.context.clear()
+            if self.camera.dead:
+                abrtn = ABRTN_MAX
+            else:
+                abrtn = min(ABRTN_MAX, (self.fov*self.health) ** -CONWAY)
+            self.edge['abrtn'].value = abrtn
+            self.edge['zoom'].value = (self.zmlvl + 1.0) / 100
+            self.combine.render(moderngl.TRIANGLES)
+        with self.profiler.measure('swap'): glfw.swap_buffers(self.window)
         glfw.set_window_title(self.window, '{} - axuy@{}:{} ({})'.format(
             self.postr, *self.addr, self.fpstr))
 
     @abstractmethod
     def control(self) -> None:
-        """Poll resizing and closing events."""
-        glfw.poll_events()
+        """Control the protagonist, with window events
+        already polled once per frame by update.
+        """
 
     def __exit__(self, exc_type, exc_value, traceback):
         Peer.__exit__(self, exc_type, exc_value, traceback)
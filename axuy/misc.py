@@ -18,12 +18,15 @@
 
 __doc__ = 'Axuy miscellaneous functions'
 __all__ = ['abspath', 'color', 'twelve', 'nine', 'indexify', 'mapidgen',
-           'mapgen', 'neighbors', 'mirror', 'normalized', 'rot33', 'placeable']
+           'mapgen', 'neighbors', 'mirror', 'normalized', 'rot33',
+           'collision_field', 'placeable', 'placeable_many',
+           'displacement', 'distance', 'SpatialHash']
 
-from itertools import (chain, combinations_with_replacement,
-                       permutations, product)
+from functools import lru_cache
+from itertools import chain, combinations_with_replacement, permutations
 from random import choices, shuffle
 from typing import Iterator, List, Tuple
+from weakref import finalize, ref
 
 import numpy
 from numpy.linalg import norm
@@ -36,13 +39,19 @@ OYZ = numpy.float32([[0, 0, 0], [0, 1, 0], [0, 1, 1],
                      [0, 1, 1], [0, 0, 1], [0, 0, 0]])
 OZX = numpy.float32([[0, 0, 0], [1, 0, 0], [1, 0, 1],
                      [1, 0, 1], [0, 0, 1], [0, 0, 0]])
+# Faces in the order they are checked by mirror: (z-1), (x-1), (y-1)
+FACES = numpy.stack([OXY, OYZ, OZX])
 AXIS = numpy.float32([0, -1, 0])
+SIZE = numpy.float32([12, 12, 9])
 
 NEIGHBORS = set(chain.from_iterable(
     map(permutations, combinations_with_replacement((-1, 0, 1), 3))))
+# Offsets of neighbor universes, in the same order as neighbors yields
+OFFSETS = numpy.float32([(i*12, j*12, k*9) for i, j, k in NEIGHBORS])
 # map.npy is generated by ../tools/mapgen
 SPACE = numpy.load(resource_filename('axuy', 'map.npy'))
 COLORS = tuple(map(numpy.float32, permutations((1.0, 0.5, 0.0))))
+FIELDS = {}     # (id(space), r): (weak reference to space, collision field)
 
 
 def abspath(resource_name) -> str:
@@ -83,11 +92,10 @@ def mapgen(mapid):
     """Return the NumPy array of shape (12, 12, 9) of bools
     generated from the given ID.
     """
-    base = numpy.stack([SPACE[i] for i in mapid]).reshape(4, 4, 3, 3, 3, 3)
-    space = numpy.zeros([12, 12, 9], dtype=bool)
-    for (i, j, k, x, y, z), occupied in numpy.ndenumerate(base):
-        if occupied: space[i*3 + x][j*3 + y][k*3 + z] = 1
-    return space
+    # Interleave block indices (i, j, k) with in-block ones (x, y, z)
+    # so that space[i*3 + x][j*3 + y][k*3 + z] = base[i][j][k][x][y][z].
+    base = SPACE[list(mapid)].reshape(4, 4, 3, 3, 3, 3)
+    return base.transpose(0, 3, 1, 4, 2, 5).reshape(12, 12, 9).astype(bool)
 
 
 def neighbors(x, y, z) -> Iterator[Tuple[float, float, float]]:
@@ -97,17 +105,35 @@ def neighbors(x, y, z) -> Iterator[Tuple[float, float, float]]:
     for i, j, k in NEIGHBORS: yield x + i*12, y + j*12, z + k*9
 
 
+def displacement(source, target) -> numpy.ndarray:
+    """Return the shortest vectors from source to images of target.
+
+    Both arguments are broadcastable arrays whose last axis has length 3.
+    """
+    delta = numpy.subtract(target, source) + SIZE/2
+    return delta % SIZE - SIZE/2
+
+
+def distance(source, target) -> numpy.ndarray:
+    """Return the distances from source to the closest images of target.
+
+    Both arguments are broadcastable arrays whose last axis has length 3.
+    """
+    return norm(displacement(source, target), axis=-1)
+
+
 def mirror(space) -> numpy.float32:
     """Return the vertices to render the mirrored space."""
-    vertices = []
-    for (x, y, z), occupied in numpy.ndenumerate(space):
-        if space[x][y][z-1] ^ occupied:
-            vertices.extend(i+j for i, j in product(neighbors(x, y, z), OXY))
-        if space[x-1][y][z] ^ occupied:
-            vertices.extend(i+j for i, j in product(neighbors(x, y, z), OYZ))
-        if space[x][y-1][z] ^ occupied:
-            vertices.extend(i+j for i, j in product(neighbors(x, y, z), OZX))
-    return numpy.stack(vertices).astype(numpy.float32)
+    space = numpy.asarray(space, dtype=bool)
+    # A face is drawn wherever a cell differs from its lower neighbor,
+    # i.e. space[x][y][z-1], space[x-1][y][z] and space[x][y-1][z].
+    faces = numpy.stack([space ^ numpy.roll(space, 1, axis)
+                         for axis in (2, 0, 1)], axis=-1)
+    *cells, kinds = numpy.nonzero(faces)
+    origins = numpy.float32(cells).T
+    vertices = (origins[:, None, None, :] + OFFSETS[None, :, None, :]
+                + FACES[kinds][:, None, :, :])
+    return vertices.reshape(-1, 3)
 
 
 def normalized(*vector) -> numpy.float32:
@@ -117,14 +143,81 @@ def normalized(*vector) -> numpy.float32:
     return v / norm(v)
 
 
+@lru_cache(maxsize=16)
+def dilate(data, shape, r) -> numpy.ndarray:
+    """Return the collision field of the space of given raw data
+    and shape for spheres of radius r.
+    """
+    if not 0 <= r < 1: raise ValueError('radius must be in [0, 1)')
+    field = numpy.frombuffer(data, dtype=bool).reshape(shape)
+    for axis, n in enumerate(shape):
+        # Each cell is split into 4 bands along the axis, indexed by
+        # whether a sphere within the band reaches the previous cell
+        # (2) and the next one (1).
+        lower = field | numpy.roll(field, 1, axis)
+        upper = field | numpy.roll(field, -1, axis)
+        bands = numpy.stack([field, upper, lower, lower | upper], axis+1)
+        field = bands.reshape(field.shape[:axis] + (n*4,) + shape[axis+1:])
+    field.flags.writeable = False
+    return field
+
+
+def collision_field(space, r=0) -> numpy.ndarray:
+    """Return the occupancy of the given space dilated by radius r.
+
+    The field has 4 bands per cell on each axis, so that whether
+    a sphere can be placed is a single lookup at its band indices.
+    It is built once per space, which is assumed to be immutable.
+    """
+    try:
+        reference, field = FIELDS[id(space), r]
+    except KeyError:
+        pass
+    else:
+        if reference() is space: return field
+
+    array = numpy.asarray(space, dtype=bool)
+    field = dilate(array.tobytes(), array.shape, r)
+    try:
+        FIELDS[id(space), r] = ref(space), field
+    except TypeError:   # not weak-referenceable, e.g. nested lists
+        pass
+    else:
+        finalize(space, FIELDS.pop, (id(space), r), None)
+    return field
+
+
+def band(x, n, r) -> int:
+    """Return the index of the band of the collision field
+    of radius r containing x on an axis of n cells.
+    """
+    x = float(x) % n
+    i = int(x)
+    f = x - i
+    return (i*4 + (f < r)*2 + (f >= 1-r)) % (n*4)
+
+
 def placeable(space, x, y, z, r=0) -> bool:
     """Return whether a sphere of radius r
     can be placed at (x, y, z) in given space.
     """
-    return not any(space[i][j][k] for i, j, k in product(
-        {twelve(x-r), twelve(x), twelve(x+r)},
-        {twelve(y-r), twelve(y), twelve(y+r)},
-        {nine(z-r), nine(z), nine(z+r)}))
+    r = float(r)
+    field = collision_field(space, r)
+    return not field[band(x, 12, r), band(y, 12, r), band(z, 9, r)]
+
+
+def placeable_many(space, points, r=0) -> numpy.ndarray:
+    """Return an array of bools indicating whether a sphere
+    of radius r can be placed at each of the given points.
+    """
+    field = collision_field(space, r)
+    sizes = numpy.array(field.shape) // 4
+    points = numpy.asarray(points, dtype=float) % sizes
+    cells = numpy.floor(points)
+    fractions = points - cells
+    bands = cells*4 + (fractions < r)*2 + (fractions >= 1-r)
+    indices = bands.astype(int) % (sizes*4)
+    return ~field[tuple(numpy.moveaxis(indices, -1, 0))]
 
 
 def rot33(magnitude, direction) -> numpy.float32:
@@ -135,3 +228,71 @@ def rot33(magnitude, direction) -> numpy.float32:
         AXIS.dot(matrix33.create_from_z_rotation(direction)),
         magnitude,
         dtype=numpy.float32)
+
+
+class SpatialHash:
+    """Uniform grid over the bounded space for finding pairs of points
+    within a distance, taking the closest images into account.
+
+    Parameters
+    ----------
+    points : array-like of shape (n, 3) of floats
+        Positions to be hashed.
+    cell : float, optional
+        Minimal cell size, which is also the largest queryable distance.
+
+    Attributes
+    ----------
+    points : numpy.ndarray of shape (n, 3) of floats
+        Hashed positions, wrapped into the bounded space.
+    shape : numpy.ndarray of shape (3,) of ints
+        Number of cells along each axis.
+    cell : float
+        Minimal cell size.
+    order : numpy.ndarray of shape (n,) of ints
+        Indices of points sorted by cell.
+    starts : numpy.ndarray of ints
+        Offsets of each cell's points in order, plus the total count.
+    """
+    def __init__(self, points, cell=1.0):
+        self.points = numpy.asarray(points, dtype=float).reshape(-1, 3) % SIZE
+        self.shape = numpy.maximum(SIZE // cell, 1).astype(int)
+        self.cell = cell
+        cells = self.cells(self.points)
+        self.order = numpy.argsort(cells, kind='stable')
+        self.starts = numpy.searchsorted(cells[self.order],
+                                         numpy.arange(self.shape.prod()+1))
+
+    def __len__(self) -> int: return len(self.points)
+
+    def indices(self, points) -> numpy.ndarray:
+        """Return the 3D cell indices of the given points."""
+        return (points % SIZE * self.shape / SIZE).astype(int) % self.shape
+
+    def cells(self, points) -> numpy.ndarray:
+        """Return the flat cell indices of the given points."""
+        return numpy.ravel_multi_index(self.indices(points).T, self.shape)
+
+    def pairs(self, queries, r) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """Return indices (i, j) of all queries[i] and points[j]
+        closer than r to each other.
+        """
+        if r > self.cell: raise ValueError('distance larger than cell size')
+        queries = numpy.asarray(queries, dtype=float).reshape(-1, 3)
+        offsets = numpy.stack(numpy.meshgrid(
+            *(numpy.unique(numpy.arange(-1, 2) % n) for n in self.shape),
+            indexing='ij'), axis=-1).reshape(-1, 3)
+        around = (self.indices(queries)[:, None] + offsets) % self.shape
+        cells = numpy.ravel_multi_index(numpy.moveaxis(around, -1, 0),
+                                        self.shape).ravel()
+
+        # Expand each candidate cell into the range of its points.
+        starts = self.starts[cells]
+        counts = self.starts[cells+1] - starts
+        total = counts.sum()
+        ends = numpy.cumsum(counts)
+        ranks = numpy.arange(total) - numpy.repeat(ends-counts, counts)
+        j = self.order[numpy.repeat(starts, counts) + ranks]
+        i = numpy.repeat(numpy.arange(len(cells)) // len(offsets), counts)
+        close = distance(queries[i], self.points[j]) < r
+        return i[close], j[close]
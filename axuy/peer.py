@@ -17,26 +17,129 @@
 # along with Axuy.  If not, see <https://www.gnu.org/licenses/>.
 
 __doc__ = 'Axuy peer'
-__all__ = ['__version__', 'PeerConfig', 'Peer']
+__all__ = ['__version__', 'Mailbox', 'PeerConfig', 'Peer']
 __version__ = '0.0.11'
 
 from abc import ABC, abstractmethod
 from argparse import ArgumentParser, FileType, RawTextHelpFormatter
+from collections import deque
 from configparser import ConfigParser
+from math import inf
 from os.path import join as pathjoin, pathsep
 from pickle import dumps, loads
-from queue import Empty, Queue
-from socket import SO_REUSEADDR, SOCK_DGRAM, SOL_SOCKET, socket
+from socket import (IP_ADD_MEMBERSHIP, IP_MULTICAST_IF, IPPROTO_IP,
+                    SO_REUSEADDR, SOCK_DGRAM, SOL_SOCKET,
+                    gethostbyname, inet_aton, socket, timeout)
 from sys import stdout
-from threading import Thread
-from typing import Iterator, Tuple
+from threading import Lock, Thread
+from time import monotonic
+from typing import Dict, Iterator, List, Optional, Tuple
+from warnings import warn
 
 from appdirs import AppDirs
+from numpy import arange, int64, ndarray, rint
+from numpy.linalg import norm
 
-from .misc import abspath, mapgen, mapidgen
-from .pico import Pico
+from .misc import SIZE, abspath, displacement, mapgen, mapidgen
+from .pico import SHARD_LIFE, Pico, ShardPool, ShardTable
+from .profiler import PROFILE_DEPTH, Profiler
+from .wire import (BATCH_HEADER, HISTORY, NOSHOT, ShotTable, State,
+                   decode_batch, decode_handshake, decode_state, diff,
+                   encode_batches, encode_handshake, encode_state,
+                   is_batch, is_pickle, match, patch)
 
 SETTINGS = abspath('settings.ini')
+SHOTS = 'state', 'events'
+BACKENDS = 'threads', 'asyncio'
+TOPOLOGIES = 'mesh', 'star'
+SELF = '', 0    # origin of the relay's own packet in its batches
+MULTICAST_REPEATS = 4   # pushes to the multicast group including each shot
+DISCOVERY_TIMEOUT = 1.0     # seconds to wait for peers in the group
+MAX_STEPS = 8   # ticks simulated per update at most, dropping the rest
+INBOX_DEPTH = 4     # packets kept per sender until synchronized
+RECEIVE_BATCH = 16  # datagrams received per wakeup at most
+JITTER_BUFFER = 16  # snapshots kept per peer for interpolation
+MAX_EXTRAPOLATION = 0.25    # seconds to extrapolate remote picos at most
+NEAR = 2.0  # distance within which peers are sent every state
+FAR = norm(SIZE/2)  # longest distance between picos
+AIM = 0.97  # cosine of the largest angle between aim and target
+VIEW = 0.5  # cosine of half of the widest field of view
+SHOT_TIMEOUT = 1.0  # seconds to keep resending unacknowledged shots
+PICKLE_WARN = '{}:{} uses the legacy pickle format, which is {}.'
+
+try:
+    from socket import MSG_DONTWAIT
+except ImportError:     # non-blocking receives are not available
+    MSG_DONTWAIT = None
+
+
+class Mailbox:
+    """Bounded inbox of decoded states, keeping only the latest few
+    from each origin, which are in order of their sequence numbers.
+
+    States older than or duplicating one already received from
+    the same origin are dropped, and so are the oldest ones pending
+    when more than depth of them arrive before being taken.
+    States more than HISTORY older than the latest one are taken
+    as from a restarted origin, whose pending states are dropped.
+    States without sequence numbers, i.e. legacy ones,
+    are only subject to the latter.
+
+    Parameters
+    ----------
+    depth : int, optional
+        Number of states kept per origin (fallback: INBOX_DEPTH).
+
+    Attributes
+    ----------
+    depth : int
+        Number of states kept per origin.
+    lock : threading.Lock
+        Lock guarding the mailbox against concurrent receivers.
+    boxes : Dict[Tuple[str, int], Deque[Tuple[Tuple[str, int], ...]]]
+        Pending (addr, state, pico) from each origin addr.
+    latest : Dict[Tuple[str, int], int]
+        Sequence number of the latest state kept from each origin.
+    arrived : int
+        Number of states received, including dropped ones.
+    superseded : int
+        Number of states dropped for newer ones.
+    reordered : int
+        Number of states dropped for arriving out of order or twice.
+    """
+
+    def __init__(self, depth=INBOX_DEPTH) -> None:
+        self.depth, self.lock = depth, Lock()
+        self.boxes, self.latest = {}, {}
+        self.arrived = self.superseded = self.reordered = 0
+
+    def __len__(self) -> int:
+        return sum(map(len, self.boxes.values()))
+
+    def put(self, addr, state, pico=None) -> None:
+        """Keep the state from addr if it is the latest, along with
+        the pico to be added for addr if it is new.
+        """
+        with self.lock:
+            self.arrived += 1
+            if state.seq:
+                latest = self.latest.get(addr, 0)
+                if state.seq + HISTORY < latest:
+                    self.boxes.pop(addr, None)
+                elif state.seq <= latest:
+                    self.reordered += 1
+                    return
+                self.latest[addr] = state.seq
+            box = self.boxes.setdefault(addr, deque())
+            if len(box) == self.depth:
+                box.popleft()
+                self.superseded += 1
+            box.append((addr, state, pico))
+
+    def take(self) -> List[Tuple[Tuple[str, int], State, Optional[Pico]]]:
+        """Return and remove all pending (addr, state, pico)."""
+        with self.lock: boxes, self.boxes = self.boxes, {}
+        return [record for box in boxes.values() for record in box]
 
 
 class PeerConfig:
@@ -54,6 +157,37 @@ class PeerConfig:
         Port to bind the peer to.
     seeder : str
         Address of the peer that created the map.
+    pickle : bool
+        Whether to exchange states with peers using the legacy
+        pickle format, which executes arbitrary code received.
+    shots : str
+        How own shards are replicated, either 'state' to send
+        their states every update or 'events' to only send
+        shots and let other peers simulate the shards.
+    backend : str
+        Networking engine, either 'threads' for blocking sockets
+        in background threads or 'asyncio' for an event loop.
+    topology : str
+        Either 'mesh' for sending states to every other peer or 'star'
+        for sending them only to the seeder, which relays them.
+    group : Optional[Tuple[str, int]]
+        Multicast group address to send states to instead of
+        individual peers, or None to disable multicasting.
+    tick : float
+        Simulation rate, in fixed steps per second.
+    delay : float
+        Time in seconds remote picos are rendered behind
+        their latest received snapshots.
+    send_rate : float
+        Most states per second sent to each peer.
+    max_rate : int
+        Most states per second wanted from each peer, or 0 for no limit.
+    min_rate : float
+        Rate in states per second own state is sent
+        to peers it is least relevant to, 0 for none.
+    profile : Optional[str]
+        Path to dump durations of stages of recent frames to on exit,
+        or None to disable profiling.
     """
 
     def __init__(self) -> None:
@@ -90,11 +224,64 @@ class PeerConfig:
         self.options.add_argument(
             '-s', '--seeder', metavar='ADDRESS',
             help='address of the peer that created the map')
+        self.options.add_argument(
+            '--pickle', action='store_true', default=None,
+            help='accept peers using the legacy pickle format'
+            ' (fallback: {})'.format(self.pickle))
+        self.options.add_argument(
+            '--shots', choices=SHOTS,
+            help='send shard states or only shots (fallback: {})'.format(
+                self.shots))
+        self.options.add_argument(
+            '--backend', choices=BACKENDS,
+            help='networking engine (fallback: {})'.format(self.backend))
+        self.options.add_argument(
+            '--topology', choices=TOPOLOGIES,
+            help='send states to all peers or through the seeder'
+            ' (fallback: {})'.format(self.topology))
+        self.options.add_argument(
+            '-r', '--tick-rate', type=float, dest='tick', metavar='HZ',
+            help='simulation steps per second (fallback: {:g})'.format(
+                self.tick))
+        self.options.add_argument(
+            '--delay', type=float, metavar='SECONDS',
+            help='interpolation delay of remote picos (fallback: {:g})'.format(
+                self.delay))
+        self.options.add_argument(
+            '--send-rate', type=float, metavar='HZ',
+            help='states sent per second at most (fallback: {:g})'.format(
+                self.send_rate))
+        self.options.add_argument(
+            '--max-rate', type=int, metavar='HZ',
+            help='states per second wanted from each peer at most,'
+            ' 0 for no limit (fallback: {})'.format(self.max_rate))
+        self.options.add_argument(
+            '--min-rate', type=float, metavar='HZ',
+            help='states sent per second to peers out of sight'
+            ' (fallback: {:g})'.format(self.min_rate))
+        self.options.add_argument(
+            '-g', '--group', metavar='ADDRESS',
+            help='multicast group to send states to (fallback: {})'.format(
+                self.config.get('Peer', 'Multicast group') or 'none'))
+        self.options.add_argument(
+            '--profile', metavar='PATH',
+            help='time stages of each frame and dump them to PATH on exit,'
+            ' as JSON if it ends with .json or CSV otherwise')
 
     def fallback(self) -> None:
         """Parse fallback configurations."""
         self.host = self.config.get('Peer', 'Host')
         self.port = self.config.getint('Peer', 'Port')
+        self.pickle = self.config.getboolean('Peer', 'Legacy pickle')
+        self.shots = self.config.get('Peer', 'Shot replication')
+        self.backend = self.config.get('Peer', 'Backend')
+        self.topology = self.config.get('Peer', 'Topology')
+        self.group = self.config.get('Peer', 'Multicast group')
+        self.tick = self.config.getfloat('Peer', 'Tick rate')
+        self.delay = self.config.getfloat('Peer', 'Interpolation delay')
+        self.send_rate = self.config.getfloat('Peer', 'Send rate')
+        self.max_rate = self.config.getint('Peer', 'Maximum receive rate')
+        self.min_rate = self.config.getfloat('Peer', 'Minimum send rate')
 
     # Fallback to None when attribute is missing
     def __getattr__(self, name): return None
@@ -109,9 +296,66 @@ class PeerConfig:
         host, port = value.split(':')
         self.__seed = host, int(port)
 
+    @property
+    def group(self) -> Optional[Tuple[str, int]]:
+        """Multicast group address."""
+        return self.__group
+
+    @group.setter
+    def group(self, value: str) -> None:
+        if not value:
+            self.__group = None
+        else:
+            host, port = value.split(':')
+            self.__group = host, int(port)
+
+    @property
+    def tick(self) -> float:
+        """Simulation rate, in fixed steps per second."""
+        return self.__tick
+
+    @tick.setter
+    def tick(self, value: float) -> None:
+        if not 0 < value < inf: raise ValueError('invalid tick rate')
+        self.__tick = value
+
+    @property
+    def send_rate(self) -> float:
+        """Most states per second sent to each peer."""
+        return self.__send_rate
+
+    @send_rate.setter
+    def send_rate(self, value: float) -> None:
+        if not 0 < value < inf: raise ValueError('invalid send rate')
+        self.__send_rate = value
+
+    @property
+    def max_rate(self) -> int:
+        """Most states per second wanted from each peer."""
+        return self.__max_rate
+
+    @max_rate.setter
+    def max_rate(self, value: int) -> None:
+        if value < 0: raise ValueError('invalid maximum receive rate')
+        self.__max_rate = value
+
+    @property
+    def min_rate(self) -> float:
+        """Rate own state is sent to peers it is least relevant to."""
+        return self.__min_rate
+
+    @min_rate.setter
+    def min_rate(self, value: float) -> None:
+        if not 0 <= value < inf:
+            raise ValueError('invalid minimum send rate')
+        self.__min_rate = value
+
     def read(self, arguments):
         """Read and parse a argparse.ArgumentParser.Namespace."""
-        for option in 'host', 'port', 'seeder':
+        for option in ('host', 'port', 'seeder', 'pickle',
+                       'shots', 'backend', 'topology', 'group',
+                       'tick', 'delay', 'send_rate', 'max_rate',
+                       'min_rate', 'profile'):
             value = getattr(arguments, option)
             if value is not None: setattr(self, option, value)
 
@@ -142,21 +386,110 @@ class Peer(ABC):
         UDP socket for exchanging instantaneous states with other peers.
     addr : Tuple[str, int]
         Own's address.
-    q : Queue[Tuple[bytes, Tuple[str, int]]]
-        Queue of (data, addr), where addr is the address of the peer
-        who sent the raw data.
+    group : Optional[Tuple[str, int]]
+        Multicast group address to send states to, if any.
+    msock : Optional[socket]
+        UDP socket receiving states sent to the multicast group.
+    inbox : Mailbox
+        Received states not yet synchronized, decoded as they arrive.
+    decoding : threading.Lock
+        Lock serializing decoding of states from concurrent receivers.
     peers : List[Tuple[str, int]]
         Addresses of connected peers.
+    pickle : bool
+        Whether to exchange states with legacy pickle peers.
+    legacy : Set[Tuple[str, int]]
+        Addresses of peers detected to be using the pickle format.
+    seq : int
+        Sequence number of the last pushed state.
+    history : Dict[int, State]
+        Recently pushed snapshots, indexed by sequence number.
+    acks : Dict[Tuple[str, int], int]
+        Sequence numbers of the latest own snapshots acknowledged
+        by each peer.
+    snapshots : Dict[Tuple[str, int], Dict[int, State]]
+        Recently received snapshots from each peer.
+    received : Dict[Tuple[str, int], int]
+        Sequence numbers of the latest snapshots received from each peer.
+    events : bool
+        Whether to replicate own shards by sending only shots.
+    fired : Dict[int, Tuple[float, np.ndarray, np.ndarray, Dict]]
+        Time, initial position and rotation of own shots, indexed
+        by shard ID, along with the sequence number of the first
+        state they are sent with to each peer.
+    seen : Dict[Tuple[str, int], Set[int]]
+        IDs of shots received from each peer.
+    relay : Optional[Tuple[str, int]]
+        Address of the peer relaying states of all others,
+        which may be own's, or None if states are sent to every peer.
+    relayed : Dict[Tuple[str, int], State]
+        Latest snapshots received from each peer since the last push,
+        to be relayed to the others.
+    forwarded : Dict[int, Dict[Tuple[str, int], State]]
+        Snapshots relayed along with recently pushed states,
+        indexed by sequence number and then origin.
+    bundled : Dict[Tuple[str, int], Dict[int, Set[Tuple[str, int]]]]
+        Origins of snapshots relayed to each peer in the same datagram
+        as recently pushed states, indexed by peer and sequence number.
+    relayed_shots : Dict[Tuple[str, int], Dict[int, Tuple[float, ...]]]
+        Shots received from each peer to be relayed to the others,
+        in the same form as fired.
+    spawned : int
+        Sequence number of the first state pushed since own pico
+        last respawned, before which health corrections are stale.
     mapid : List[int]
         Permutation of map building blocks.
     space : numpy.ndarray of shape (12, 12, 9) of bools
         3D array of occupied space.
+    shards : ShardPool
+        All shards present in the map.
     pico : Pico
         Protagonist.
     picos : Dict[Tuple[str, int], Pico]
         All picos present in the map.
     last_time : float
         Timestamp of the previous update.
+    tick : float
+        Simulation rate, in fixed steps per second.
+    frame : float
+        Duration of the last update in seconds.
+    accumulator : float
+        Time yet to be simulated in seconds, less than a step
+        after each update.
+    previous : Dict[Tuple[str, int], np.ndarray]
+        Positions of locally simulated picos before the last step.
+    prior : Tuple[np.ndarray, np.ndarray, np.ndarray]
+        Owner codes, IDs and positions of shards before the last step.
+    delay : float
+        Time in seconds remote picos are played behind
+        their latest received snapshots.
+    buffers : Dict[Tuple[str, int], Deque[Tuple[float, float, State]]]
+        Recently received snapshots from each peer, in order of
+        the time they were taken, along with their arrival time.
+    played : Dict[Tuple[str, int], float]
+        Time of the latest snapshot played from each peer.
+    send_rate : float
+        Rate in states per second own state is pushed at,
+        regardless of the loop rate.
+    next_push : float
+        Time own state is to be pushed next.
+    max_rate : int
+        Most states per second wanted from each peer, or 0 for no limit.
+    limits : Dict[Tuple[str, int], int]
+        Most states per second wanted by each peer, or 0 for no limit.
+    min_rate : float
+        Rate in states per second own state is sent
+        to peers it is least relevant to.
+    rates : Dict[Tuple[str, int], float]
+        Current rates in states per second own state is sent
+        to each peer, which can be tuned through relevance.
+    sent : Dict[Tuple[str, int], float]
+        Time own state was last sent to each peer.
+    profile : Optional[str]
+        Path to dump the profile to on exit, or None.
+    profiler : Profiler
+        Recorder of durations of stages of recent frames,
+        which is disabled unless there is a path to dump to.
     """
 
     def __init__(self, config):
@@ -164,19 +497,52 @@ class Peer(ABC):
         self.sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
         self.sock.bind((config.host, config.port))
         self.addr = self.sock.getsockname()
-        self.q = Queue()
+        self.group, self.msock = config.group, None
+        if self.group is not None:
+            # Use the interface of the bound host, so that
+            # multicasting can be done over loopback.
+            interface = inet_aton(gethostbyname(config.host))
+            self.sock.setsockopt(IPPROTO_IP, IP_MULTICAST_IF, interface)
+            self.msock = socket(type=SOCK_DGRAM)
+            self.msock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+            self.msock.bind(('', self.group[1]))
+            self.msock.setsockopt(IPPROTO_IP, IP_ADD_MEMBERSHIP, inet_aton(
+                gethostbyname(self.group[0])) + interface)
+        self.inbox, self.decoding = Mailbox(), Lock()
+        self.pickle, self.legacy, self.seq = config.pickle, set(), 0
+        self.history, self.acks = {}, {}
+        self.snapshots, self.received = {}, {}
+        self.events, self.fired, self.seen = config.shots == 'events', {}, {}
 
-        if config.seeder is None:
+        seeder = config.seeder
+        if seeder is None and self.msock is not None: seeder = self.discover()
+        if seeder is None:
             self.mapid, self.peers = mapidgen(), []
         else:
-            client = socket()
-            client.connect(config.seeder)
-            self.mapid, self.peers = loads(client.recv(1024))
+            # The seeder is resolved to where its datagrams come from.
+            self.mapid, self.peers, seeder = self.join(seeder)
+        if config.topology != 'star':
+            self.relay = None
+        else:
+            self.relay = self.addr if seeder is None else seeder
+        self.relayed, self.forwarded, self.relayed_shots = {}, {}, {}
+        self.bundled = {}
+        self.spawned = 0
 
         self.space = mapgen(self.mapid)
-        self.pico = Pico(self.addr, self.space)
+        self.shards = ShardPool(self.space)
+        self.pico = Pico(self.addr, self.space, pool=self.shards)
         self.picos = {self.addr: self.pico}
         self.last_time = self.get_time()
+        self.tick, self.frame, self.accumulator = config.tick, 0.0, 0.0
+        self.fps, self.previous = self.tick, {}
+        self.prior = self.shards.owner, self.shards.ids, self.shards.pos
+        self.delay, self.buffers, self.played = config.delay, {}, {}
+        self.send_rate, self.next_push = config.send_rate, self.last_time
+        self.max_rate, self.limits = config.max_rate, {}
+        self.min_rate, self.rates, self.sent = config.min_rate, {}, {}
+        self.profile = config.profile
+        self.profiler = Profiler(depth=PROFILE_DEPTH if self.profile else 0)
 
     def __enter__(self): return self
 
@@ -186,27 +552,77 @@ class Peer(ABC):
         """Peer status."""
 
     @property
-    def ready(self) -> Iterator[Tuple[bytes, Tuple[str, int]]]:
-        """Iterator of (data, addr) that can be used without waiting,
-        where addr is the address of the peer who sent the data.
+    def ready(self) -> Iterator[Tuple[Tuple[str, int], State,
+                                      Optional[Pico]]]:
+        """Iterator of (addr, state, pico) that can be used without
+        waiting, where addr is the address of the peer the state
+        originates from and pico is None unless addr is new.
         """
-        while True:
-            try:
-                yield self.q.get_nowait()
-            except Empty:
-                break
-            else:
-                self.q.task_done()
+        yield from self.inbox.take()
 
     @property
     def fps(self) -> float:
-        """Current loop rate."""
+        """Rate of steps the simulation is advanced by."""
         return self.pico.fps
 
     @fps.setter
     def fps(self, fps: float) -> None:
         self.pico.fps = fps
 
+    def discover(self) -> Optional[Tuple[str, int]]:
+        """Return the address of a peer sending states to the multicast
+        group, or None if there is none.
+
+        Sources of datagrams other than valid state packets are ignored.
+        """
+        deadline = monotonic() + DISCOVERY_TIMEOUT
+        try:
+            while True:
+                remaining = deadline - monotonic()
+                if remaining <= 0: return None
+                self.msock.settimeout(remaining)
+                data, addr = self.msock.recvfrom(1 << 16)
+                try:
+                    decode_state(data)
+                except ValueError:
+                    continue
+                return addr
+        except timeout:
+            return None
+        finally:
+            self.msock.settimeout(None)
+
+    def join(self, seeder) -> Tuple[List[int], List[Tuple[str, int]],
+                                    Tuple[str, int]]:
+        """Return the map ID and addresses of connected peers
+        received from the seeder, along with its resolved address.
+        """
+        with socket() as client:
+            client.connect(seeder)
+            data = b''.join(iter(lambda: client.recv(1 << 16), b''))
+            return (*self.unshake(data), client.getpeername())
+
+    def handshake(self) -> bytes:
+        """Return the handshake sent to new peers, which is pickled
+        for peers of Axuy 0.0.11 and older if pickle is accepted.
+        """
+        if self.pickle: return dumps((self.mapid, self.peers+[self.addr]))
+        return encode_handshake(self.mapid, self.peers+[self.addr])
+
+    def unshake(self, data) -> Tuple[List[int], List[Tuple[str, int]]]:
+        """Return the map ID and addresses of connected peers
+        stored in the handshake received from the seeder.
+
+        Raise ValueError if the handshake is invalid or pickled
+        while pickle is not accepted.
+        """
+        if not is_pickle(data): return decode_handshake(data)
+        if not self.pickle:
+            raise ValueError('the seeder uses the legacy pickle format,'
+                             ' which is only accepted with --pickle')
+        mapid, peers = loads(data)
+        return mapid, [tuple(peer) for peer in peers]
+
     def serve(self) -> None:
         """Initiate other peers."""
         with socket() as server:    # TCP server
@@ -216,68 +632,472 @@ class Peer(ABC):
             print('Axuy is listening at {}:{}'.format(*self.addr))
             while self.is_running:
                 conn, addr = server.accept()
-                conn.send(dumps((self.mapid, self.peers+[self.addr])))
+                conn.sendall(self.handshake())
                 conn.close()
             server.close()
 
-    def pull(self) -> None:
-        """Receive other peers' states."""
-        while self.is_running: self.q.put(self.sock.recvfrom(1 << 16))
-        while not self.q.empty():
-            self.q.get()
-            self.q.task_done()
+    def pull(self, sock=None) -> None:
+        """Receive other peers' states from the given socket
+        (fallback: the peer's own) into preallocated buffers.
+
+        Where non-blocking receives are available, datagrams already
+        waiting are drained after each blocking one, up to
+        RECEIVE_BATCH at a time.
+        """
+        if sock is None: sock = self.sock
+        buffers = [memoryview(bytearray(1 << 16))
+                   for i in range(RECEIVE_BATCH if MSG_DONTWAIT else 1)]
+        while self.is_running:
+            received = [sock.recvfrom_into(buffers[0])]
+            for buffer in buffers[1:]:
+                try:
+                    received.append(sock.recvfrom_into(buffer, 0,
+                                                       MSG_DONTWAIT))
+                except BlockingIOError:
+                    break
+            # Buffers are reused, so they are decoded before that.
+            for buffer, (size, sender) in zip(buffers, received):
+                self.receive(buffer[:size], sender)
+
+    def send(self, data, address) -> None:
+        """Send data to the peer at the given address."""
+        self.sock.sendto(data, address)
 
     @abstractmethod
     def get_time(self) -> float:
         """Return the current time in seconds."""
 
-    def add_pico(self, address):
-        """Add pico from given address."""
-        self.picos[address] = Pico(address, self.space)
+    def add_pico(self, address, pico=None):
+        """Add pico from given address, or the given one if any."""
+        if pico is None: pico = Pico(address, self.space, pool=self.shards)
+        self.picos[address] = pico
+
+    def decode(self, data, addr) -> Optional[State]:
+        """Return the state decoded from data sent from addr,
+        or None if it is unusable.
+        """
+        if is_pickle(data):
+            if addr not in self.legacy:
+                self.legacy.add(addr)
+                warn(PICKLE_WARN.format(*addr, 'accepted' if self.pickle
+                                        else 'ignored'), RuntimeWarning)
+            if not self.pickle: return None
+            health, pos, rot, shards = loads(data)
+            columns = tuple(zip(*shards.values())) or ((), (), ())
+            return State(0, health, pos, rot,
+                         ShardTable(list(shards), *columns))
+        try:
+            state = decode_state(data)
+        except ValueError as e:
+            warn('{}:{}: {}'.format(*addr, e), RuntimeWarning)
+            return None
+
+        # Snapshots far behind are from a restarted origin,
+        # whose old ones would be wrong baselines.
+        if state.seq + HISTORY < self.received.get(addr, 0):
+            del self.snapshots[addr], self.received[addr]
+            self.acks.pop(addr, None)
+        # Acknowledgements of states not pushed yet are meant for
+        # a previous run of own on the same address.
+        if state.ack <= self.seq:
+            self.acks[addr] = max(self.acks.get(addr, 0), state.ack)
+        self.limits[addr] = state.rate
+        snapshots = self.snapshots.setdefault(addr, {})
+        if state.base:
+            try:
+                state = patch(snapshots[state.base], state)
+            except KeyError:    # baseline already forgotten
+                return None
+        snapshots[state.seq] = state
+        for seq in [seq for seq in snapshots if seq <= state.seq-HISTORY]:
+            del snapshots[seq]
+        self.received[addr] = max(self.received.get(addr, 0), state.seq)
+        return state
+
+    @property
+    def relaying(self) -> bool:
+        """Whether own is relaying states of other peers."""
+        return self.relay == self.addr
+
+    @property
+    def targets(self) -> List[Tuple[str, int]]:
+        """Addresses of peers to push states to individually."""
+        if self.group is not None:
+            return [peer for peer in self.peers if peer in self.legacy]
+        if self.relay is None or self.relaying: return self.peers
+        return [self.relay]
+
+    def unbatch(self, data, addr) -> List[Tuple[bytes, Tuple[str, int]]]:
+        """Return the list of (data, addr) packed in the raw data
+        received from addr, where addr is the address of the peer
+        the packet originates from.
+
+        Batches are only accepted from the relay, since the origins
+        in them are taken as given.
+        """
+        if not is_batch(data): return [(data, addr)]
+        try:
+            if addr != self.relay or self.relaying:
+                raise ValueError('batch not from the relay')
+            packets = decode_batch(data)
+        except ValueError as e:
+            warn('{}:{}: {}'.format(*addr, e), RuntimeWarning)
+            return []
+        return [(packet, addr if origin == SELF else origin)
+                for packet, origin in packets]
+
+    def receive(self, raw, sender) -> None:
+        """Decode the raw data received from sender into states
+        ready to be synchronized and put them into the inbox.
+
+        This is done as packets arrive, e.g. in the pull threads,
+        along with the construction of picos of new peers.
+        """
+        for data, addr in self.unbatch(raw, sender):
+            # Only relays may send states of own pico,
+            # to correct its health.
+            if addr == self.addr and self.relay in (None, self.addr):
+                continue
+            with self.decoding: state = self.decode(data, addr)
+            if state is None: continue
+            if addr == self.addr:
+                self.inbox.put(addr, state)
+            elif state.pos is not None:     # not a spectator
+                pico = None
+                if addr not in self.picos:
+                    pico = Pico(addr, self.space, state.health, state.pos,
+                                state.rot, self.shards)
+                self.inbox.put(addr, state, pico)
 
     def sync(self) -> None:
         """Synchronize states received from other peers."""
-        for data, addr in self.ready:
+        for addr, state, pico in self.ready:
+            if addr == self.addr:
+                if state.seq >= self.spawned: self.pico.health = state.health
+                continue
             if addr not in self.picos:
                 self.peers.append(addr)
-                self.add_pico(addr)
-            self.picos[addr].sync(*loads(data))
+                self.add_pico(addr, pico)
+            self.buffer(addr, state)
+            if self.relaying:
+                self.relayed[addr] = state
+                shots = self.relayed_shots.setdefault(addr, {})
+                for index, age, position, rotation in zip(*state.shots):
+                    shots.setdefault(index, (self.last_time-age, position,
+                                             rotation, {}))
+        self.playout()
+
+    def buffer(self, address, state) -> None:
+        """Store the snapshot received from the given address
+        to be played later, unless it is older than the latest one.
+
+        Snapshots arrive in order of their sequence numbers,
+        unless the origin has restarted, in which case those
+        buffered and its seen and relayed shots are forgotten.
+        """
+        buffer = self.buffers.setdefault(address, deque(maxlen=JITTER_BUFFER))
+        if buffer and state.seq < buffer[-1][2].seq:
+            buffer.clear()
+            self.played.pop(address, None)
+            self.seen.pop(address, None)
+            self.relayed_shots.pop(address, None)
+        # Legacy snapshots are not timestamped by their senders.
+        time = state.time or self.last_time
+        if buffer and time <= buffer[-1][0]: return
+        buffer.append((time, self.last_time, state))
+
+    def playout(self) -> None:
+        """Move remote picos to where they were the interpolation delay
+        before their latest snapshots, interpolating between buffered
+        snapshots or extrapolating from the last two of them.
+
+        Health, shards and shots of snapshots are applied as they
+        are played.  The offset between each peer's clock and own
+        is estimated by the snapshot arriving with the least delay.
+        """
+        for address, buffer in self.buffers.items():
+            if not buffer: continue
+            pico = self.picos[address]
+            offset = max(time - arrival for time, arrival, state in buffer)
+            target = self.last_time + offset - self.delay
+            played = self.played.get(address, float('-inf'))
+            before = after = None
+            for entry in buffer:
+                if entry[0] > target:
+                    after = entry
+                    break
+                before = entry
+                if entry[0] > played: self.spawn(address, entry[2].shots)
+
+            if before is None:  # too early for any snapshot
+                time, arrival, state = after
+                pico.sync(state.health, state.pos, state.rot, state.shards)
+                continue
+            time, arrival, state = before
+            if time > played:
+                self.played[address] = time
+                pico.sync(state.health, state.pos, state.rot, state.shards)
+            if after is not None:
+                then, arrival, upcoming = after
+                fraction = (target-time) / (then-time)
+                pico.pos = (state.pos + displacement(
+                    state.pos, upcoming.pos)*fraction) % SIZE
+                if fraction >= 0.5: pico.rot = upcoming.rot
+            elif len(buffer) > 1:
+                then, arrival, past = buffer[-2]
+                velocity = displacement(past.pos, state.pos) / (time-then)
+                elapsed = min(target-time, MAX_EXTRAPOLATION)
+                pico.pos = (state.pos + velocity*elapsed) % SIZE
+
+    def spawn(self, address, shots) -> None:
+        """Add shards of new shots from the given address
+        and simulate them up to their ages.
+        """
+        seen = self.seen.setdefault(address, set())
+        new = [i for i, index in enumerate(shots.ids.tolist())
+               if index not in seen]
+        if not new: return
+        seen.update(shots.ids[new].tolist())
+        start = len(self.shards)
+        self.shards.extend(address, shots.ids[new], shots.pos[new],
+                           shots.rot[new], SHARD_LIFE)
+
+        # Latency is not compensated for, only the time
+        # the shots spent waiting to be acknowledged.
+        rows, steps = arange(start, len(self.shards)), rint(
+            shots.age[new] * self.tick)
+        picos = list(self.picos.values())
+        while True:
+            ongoing = (steps > 0) & (self.shards.power[rows] > 0)
+            if not ongoing.any(): break
+            rows, steps = rows[ongoing], steps[ongoing] - 1
+            self.shards.update(self.tick, picos, rows)
+
+    def shots(self, peer, fired=None) -> ShotTable:
+        """Return shots among the given ones (fallback: own)
+        not yet acknowledged by the given peer, or sent to
+        the multicast group fewer than MULTICAST_REPEATS times.
+        """
+        if fired is None: fired = self.fired
+        if peer == self.group:
+            acked = self.seq - MULTICAST_REPEATS
+        else:
+            acked = self.acks.get(peer, 0)
+        shots = [(index, self.last_time-time, position, rotation)
+                 for index, (time, position, rotation, sent)
+                 in fired.items()
+                 if sent.setdefault(peer, self.seq) > acked]
+        if not shots: return NOSHOT
+        return ShotTable(*map(list, zip(*shots)))
+
+    def snapshot(self) -> State:
+        """Return the full snapshot of own pico and shards."""
+        shards = None if self.events else self.shards.table(self.addr)
+        return State(self.seq, self.pico.health, self.pico.pos, self.pico.rot,
+                     shards, time=self.last_time, rate=self.max_rate)
+
+    def relayed_to(self, peer, relayed) -> Dict[Tuple[str, int], State]:
+        """Return snapshots to be relayed to the given peer
+        among the given ones, indexed by origin.
+        """
+        return {addr: state for addr, state in relayed.items()
+                if addr != peer}
+
+    def relevance(self, peer) -> float:
+        """Return how relevant own state is to the given peer, from 0
+        if own pico is out of its sight to 1 if they are near each
+        other or either is aimed at by the other.
+
+        In between, the relevance decreases with the toroidal distance.
+        States are always relevant to unknown peers and in star
+        topology, where they are relayed to everyone.
+        """
+        pico = self.picos.get(peer)
+        if pico is None or self.relay is not None: return 1.0
+        offset = displacement(pico.pos, self.pico.pos)
+        length = norm(offset)
+        if length <= NEAR: return 1.0
+        direction = offset / length
+        facing = pico.rot[-1] @ direction
+        if facing >= AIM or self.pico.rot[-1] @ direction <= -AIM: return 1.0
+        if facing < VIEW: return 0.0
+        return 1.0 - (length-NEAR)/(FAR-NEAR)
+
+    def due(self, peer, relevance, armed=False) -> bool:
+        """Return whether own state is due to be sent to the given peer
+        at the rate of the given relevance, between min_rate
+        and send_rate, but no faster than the peer wants.
+
+        Nothing is due at the rate of 0, unless own shots or shards
+        are armed, in which case states are due at the send rate,
+        since each peer resolves hits on its own pico.
+        """
+        low = min(self.min_rate, self.send_rate)
+        rate = low + (self.send_rate-low)*relevance
+        if rate <= 0 and armed: rate = self.send_rate
+        if self.limits.get(peer): rate = min(rate, self.limits[peer])
+        self.rates[peer] = rate
+        if rate <= 0: return False
+        # Half a push is tolerated for states to be sent
+        # at every push at full rate.
+        elapsed = self.last_time - self.sent.get(peer, float('-inf'))
+        if elapsed < 1/rate - 0.5/self.send_rate: return False
+        self.sent[peer] = self.last_time
+        return True
 
     def push(self) -> None:
-        """Push states to other peers."""
-        shards = {i: (s.pos, s.rot, s.power)
-                  for i, s in self.pico.shards.items()}
-        data = dumps([self.pico.health, self.pico.pos, self.pico.rot, shards])
-        for peer in self.peers: self.sock.sendto(data, peer)
+        """Push states to other peers, each at its own rate.
+
+        Shards are sent to every peer, even those out of own sight,
+        since each peer resolves hits on its own pico.
+        """
+        self.seq += 1
+        state = self.snapshot()
+        self.history[self.seq] = state
+        self.history.pop(self.seq - HISTORY, None)
+        if self.events:
+            for index, position, rotation in self.pico.fired:
+                self.fired[index] = self.last_time, position, rotation, {}
+            for index, shot in tuple(self.fired.items()):
+                if self.last_time - shot[0] > SHOT_TIMEOUT:
+                    del self.fired[index]
+        self.pico.fired.clear()
+        for shots in self.relayed_shots.values():
+            for index, shot in tuple(shots.items()):
+                if self.last_time - shot[0] > SHOT_TIMEOUT: del shots[index]
+        if self.pickle and self.legacy:
+            shards = self.shards.table(self.addr)
+            legacy = dumps([self.pico.health, self.pico.pos, self.pico.rot,
+                            dict(zip(shards.ids.tolist(), zip(*shards[1:])))])
+
+        armed = bool(self.fired) or len(self.shards.rows(self.addr)) > 0
+
+        relayed, self.relayed = self.relayed, {}
+        if self.group is not None:
+            # Acknowledgements cannot be told apart in the group,
+            # so full snapshots are sent and shots are repeated.
+            snapshot = state._replace(shots=self.shots(self.group))
+            self.send(encode_state(snapshot), self.group)
+        if self.relaying:
+            self.forwarded[self.seq] = relayed
+            self.forwarded.pop(self.seq - HISTORY, None)
+
+        for peer in self.targets:
+            if peer in self.legacy:
+                if self.pickle: self.send(legacy, peer)
+                continue
+            if not self.due(peer, self.relevance(peer), armed): continue
+            # Send only what changed since the snapshot the peer
+            # acknowledged, or everything if it is too old.
+            baseline = self.history.get(self.acks.get(peer))
+            delta = state if baseline is None else diff(state, baseline)
+            delta = delta._replace(ack=self.received.get(peer, 0),
+                                   shots=self.shots(peer))
+            if not self.relaying:
+                self.send(encode_state(delta), peer)
+                continue
+            packets = [(encode_state(delta), SELF)]
+            # Snapshots of others are relayed as deltas against
+            # those sent along with the state the peer acknowledged,
+            # in the same datagram, which it is known to have received.
+            # Shots of others ride along their snapshots to the peer
+            # until the peer acknowledges a state sent with them.
+            acked = self.acks.get(peer)
+            forwarded = self.forwarded.get(acked, {})
+            bundled = self.bundled.setdefault(peer, {})
+            for addr, snapshot in self.relayed_to(peer, relayed).items():
+                # Peers keep no snapshots of their own picos.
+                if addr != peer:
+                    baseline = forwarded.get(addr)
+                    if baseline is not None and addr in bundled.get(acked, ()):
+                        snapshot = diff(snapshot, baseline)
+                    snapshot = snapshot._replace(shots=self.shots(
+                        peer, self.relayed_shots.get(addr, {})))
+                packets.append((encode_state(snapshot._replace(ack=0)), addr))
+            batches = list(encode_batches(packets))
+            count = BATCH_HEADER.unpack_from(batches[0])[-1]
+            bundled[self.seq] = {addr for packet, addr in packets[1:count]}
+            for seq in [seq for seq in bundled if seq <= self.seq-HISTORY]:
+                del bundled[seq]
+            for batch in batches: self.send(batch, peer)
 
     @abstractmethod
     def control(self) -> None:
         """Control the protagonist."""
         self.pico.update()  # just a reminder that this needs to be called
 
+    @property
+    def alpha(self) -> float:
+        """Fraction of a step elapsed since the last simulated state."""
+        return self.accumulator * self.tick
+
+    def interpolate(self, pico) -> ndarray:
+        """Return the position of pico interpolated between
+        its states before and after the last step.
+        """
+        previous = self.previous.get(pico.addr)
+        if previous is None: return pico.pos
+        return (previous + displacement(previous, pico.pos)*self.alpha) % SIZE
+
+    def interpolate_shards(self) -> ndarray:
+        """Return the positions of shards in the pool interpolated
+        between their states before and after the last step.
+        """
+        owners, ids, positions = self.prior
+        # Shards are identified by their owners and IDs across steps.
+        exist, found = match(self.shards.owner.astype(int64) << 32
+                             | self.shards.ids,
+                             owners.astype(int64) << 32 | ids)
+        result = self.shards.pos.copy()
+        previous, current = positions[found[exist]], result[exist]
+        result[exist] = (previous + displacement(previous, current)
+                         * self.alpha) % SIZE
+        return result
+
+    def step(self) -> None:
+        """Advance the simulation by a fixed step."""
+        self.previous = {self.addr: self.pico.pos}
+        self.prior = (self.shards.owner.copy(), self.shards.ids.copy(),
+                      self.shards.pos.copy())
+        self.fps = self.tick    # in case the protagonist has respawned
+        dead = self.pico.dead
+        with self.profiler.measure('control'): self.control()
+        if dead and not self.pico.dead: self.spawned = self.seq + 1
+        with self.profiler.measure('shards'):
+            self.shards.update(self.tick, list(self.picos.values()))
+            self.shards.collect()
+
     def update(self) -> None:
-        """Update internal states and send them to other peers."""
+        """Update internal states in fixed steps for the time elapsed
+        and send them to other peers if a push is due.
+        """
+        self.profiler.tick()
         next_time = self.get_time()
-        self.fps = 1 / (next_time-self.last_time)
+        self.frame = next_time - self.last_time
         self.last_time = next_time
+        self.accumulator = min(self.accumulator + self.frame,
+                               MAX_STEPS / self.tick)
 
-        self.sync()
-        self.control()
-        picos = list(self.picos.values())
-        for pico in picos:
-            shards = {}
-            for index, shard in pico.shards.items():
-                shard.update(self.fps, picos)
-                if shard.power: shards[index] = shard
-            pico.shards = shards
-        self.push()
+        with self.profiler.measure('sync'): self.sync()
+        steps = int(self.accumulator * self.tick)
+        for i in range(steps): self.step()
+        self.accumulator -= steps / self.tick
+        if self.last_time < self.next_push: return
+        # Fall behind instead of pushing in a burst.
+        self.next_push = max(self.next_push+1/self.send_rate, self.last_time)
+        with self.profiler.measure('push'): self.push()
 
     def run(self) -> None:
         """Start main loop."""
         Thread(target=self.serve, daemon=True).start()
         Thread(target=self.pull, daemon=True).start()
+        if self.msock is not None:
+            Thread(target=self.pull, args=(self.msock,), daemon=True).start()
         while self.is_running: self.update()
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.q.join()
         self.sock.close()
+        if self.msock is not None: self.msock.close()
+        if self.profile is not None:
+            self.profiler.dump(self.profile)
+            print(self.profiler.summary())
@@ -18,16 +18,19 @@
 
 __doc__ = 'Axuy module for character and bullet class'
 __all__ = ['TETRAVERTICES', 'OCTOVERTICES', 'RPICO', 'RSHARD', 'RCOLL', 'INV',
-           'PICO_SPEED', 'SHARD_SPEED', 'SHARD_LIFE', 'RPS', 'Pico', 'Shard']
+           'PICO_SPEED', 'SHARD_SPEED', 'SHARD_LIFE', 'RPS',
+           'Pico', 'PicoArray', 'Shard', 'ShardPool', 'ShardTable']
 
 from itertools import combinations
 from math import acos, atan2, log10, pi, sqrt
 from random import random
+from typing import Dict, Iterator, NamedTuple, Tuple
 
 import numpy as np
 from numpy.linalg import norm
 
-from .misc import normalized, placeable, rot33
+from .misc import (SIZE, SpatialHash, normalized,
+                   placeable, placeable_many, rot33)
 
 TETRAVERTICES = np.float32([[0, sqrt(8), -1], [sqrt(6), -sqrt(2), -1],
                             [0, 0, 3], [-sqrt(6), -sqrt(2), -1]]) / 18
@@ -48,10 +51,225 @@ SHARD_LIFE = 3  # bounces
 RPS = pi    # rounds per second
 
 
+class ShardTable(NamedTuple):
+    """States of shards owned by a pico, as parallel arrays."""
+    ids: np.ndarray
+    pos: np.ndarray
+    rot: np.ndarray
+    power: np.ndarray
+
+
+class ShardPool:
+    """Structure of arrays holding states of shards of all picos
+    so that they can be updated at once.
+
+    Parameters
+    ----------
+    space : np.ndarray of shape (12, 12, 9) of bools
+        3D array of occupied space.
+    capacity : int, optional
+        Number of shards the pool can hold before growing.
+
+    Attributes
+    ----------
+    space : np.ndarray of shape (12, 12, 9) of bools
+        3D array of occupied space.
+    size : int
+        Number of shards in the pool.
+    owners : List[Tuple[str, int]]
+        IP addresses (host, port) of shard owners, indexed by owner code.
+    codes : Dict[Tuple[str, int], int]
+        Owner codes, indexed by IP address.
+    """
+    def __init__(self, space, capacity=64):
+        self.space = space
+        self.size = 0
+        self.owners, self.codes = [], {}
+        self.__issued = {}
+        self.__pos = np.zeros((capacity, 3), dtype=np.float32)
+        self.__rot = np.zeros((capacity, 3, 3), dtype=np.float32)
+        self.__power = np.zeros(capacity, dtype=np.int32)
+        self.__owner = np.zeros(capacity, dtype=np.int32)
+        self.__ids = np.zeros(capacity, dtype=np.int64)
+
+    def __len__(self) -> int: return self.size
+
+    def __getitem__(self, index) -> 'Shard':
+        """Return the shard at the given row, which stays valid
+        until the next collection.
+        """
+        if not -self.size <= index < self.size:
+            raise IndexError('shard index out of range')
+        shard = Shard.__new__(Shard)
+        shard.pool, shard.index = self, index % self.size
+        return shard
+
+    def __iter__(self) -> Iterator['Shard']:
+        return (self[i] for i in range(self.size))
+
+    @property
+    def pos(self) -> np.ndarray:
+        """Positions, as a NumPy array of shape (size, 3)."""
+        return self.__pos[:self.size]
+
+    @property
+    def rot(self) -> np.ndarray:
+        """Rotational matrices, as a NumPy array of shape (size, 3, 3)."""
+        return self.__rot[:self.size]
+
+    @property
+    def power(self) -> np.ndarray:
+        """Relative destructive powers, as a NumPy array of ints."""
+        return self.__power[:self.size]
+
+    @property
+    def owner(self) -> np.ndarray:
+        """Owner codes, as a NumPy array of ints."""
+        return self.__owner[:self.size]
+
+    @property
+    def ids(self) -> np.ndarray:
+        """Shard indices unique per owner, as a NumPy array of ints."""
+        return self.__ids[:self.size]
+
+    def code(self, address) -> int:
+        """Return the code of the owner at the given address."""
+        try:
+            return self.codes[address]
+        except KeyError:
+            self.owners.append(address)
+            self.codes[address] = code = len(self.owners) - 1
+            return code
+
+    def rows(self, address) -> np.ndarray:
+        """Return the rows of shards owned by the given address."""
+        if address not in self.codes: return np.arange(0)
+        return np.flatnonzero(self.owner == self.codes[address])
+
+    def shards(self, address) -> Dict[int, 'Shard']:
+        """Return shards owned by the given address, indexed by ID."""
+        return {int(self.ids[i]): self[i] for i in self.rows(address)}
+
+    def table(self, address) -> ShardTable:
+        """Return a copy of states of shards owned by the given address."""
+        rows = self.rows(address)
+        return ShardTable(self.ids[rows], self.pos[rows],
+                          self.rot[rows], self.power[rows])
+
+    def next_id(self, address) -> int:
+        """Return a shard ID never used by the given owner,
+        so that shots can be told apart by their IDs.
+        """
+        index = max(self.__issued.get(address, 0),
+                    int(self.ids[self.rows(address)].max(initial=0))) + 1
+        self.__issued[address] = index
+        return index
+
+    def reserve(self, capacity):
+        """Grow the pool so that it can hold the given number of shards."""
+        if capacity <= len(self.__pos): return
+        capacity = max(capacity, len(self.__pos) * 2)
+
+        def grown(array):
+            result = np.zeros((capacity,)+array.shape[1:], dtype=array.dtype)
+            result[:self.size] = array[:self.size]
+            return result
+
+        self.__pos, self.__rot = grown(self.__pos), grown(self.__rot)
+        self.__power, self.__owner = grown(self.__power), grown(self.__owner)
+        self.__ids = grown(self.__ids)
+
+    def extend(self, address, ids, positions, rotations, powers):
+        """Append shards owned by the given address."""
+        n = len(ids)
+        self.reserve(self.size + n)
+        rows = slice(self.size, self.size + n)
+        self.__pos[rows] = np.reshape(positions, (n, 3)) % SIZE
+        self.__rot[rows] = np.reshape(rotations, (n, 3, 3))
+        self.__power[rows] = powers
+        self.__owner[rows] = self.code(address)
+        self.__ids[rows] = ids
+        self.size += n
+
+    def add(self, address, index, position, rotation,
+            power=SHARD_LIFE) -> int:
+        """Append a shard and return its row."""
+        self.extend(address, [index], [position], [rotation], [power])
+        return self.size - 1
+
+    def sync(self, address, ids, positions, rotations, powers):
+        """Synchronize states of shards owned by the given address
+        received from other peers.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        rows = self.rows(address)
+        rows = rows[np.argsort(self.ids[rows])]
+        found = np.searchsorted(self.ids[rows], ids)
+        exist = found < len(rows)
+        exist[exist] = self.ids[rows[found[exist]]] == ids[exist]
+        targets = rows[found[exist]]
+
+        positions = np.reshape(positions, (-1, 3))
+        rotations = np.reshape(rotations, (-1, 3, 3))
+        powers = np.asarray(powers)
+        self.pos[targets] = positions[exist] % SIZE
+        self.rot[targets] = rotations[exist]
+        self.power[targets] = powers[exist]
+        new = ~exist
+        if new.any():
+            self.extend(address, ids[new], positions[new],
+                        rotations[new], powers[new])
+
+    def clear(self, address):
+        """Remove all shards owned by the given address."""
+        if address in self.codes:
+            self.power[self.owner == self.codes[address]] = 0
+            self.collect()
+
+    def collect(self):
+        """Remove powerless shards."""
+        alive = np.flatnonzero(self.power)
+        n = len(alive)
+        for array in self.pos, self.rot, self.power, self.owner, self.ids:
+            array[:n] = array[alive]
+        self.size = n
+
+    def update(self, fps, picos, rows=slice(None)):
+        """Update states of shards at given rows (fallback: all)."""
+        pos, rot, power = self.pos[rows], self.rot[rows], self.power[rows]
+        if not len(pos): return
+        moved = pos + rot[:, -1]/fps*SHARD_SPEED
+        bounces = np.stack([
+            ~placeable_many(self.space, np.where(axis, moved, pos), RSHARD)
+            for axis in np.eye(3, dtype=bool)], axis=-1)
+        # Multiplying by INV[axis] negates the axis's column.
+        rot = rot * np.where(bounces, -1, 1)[:, None, :].astype(np.float32)
+        pos = (pos + rot[:, -1]/fps*SHARD_SPEED) % SIZE
+        power = power - bounces.any(axis=1)
+
+        if picos:
+            grid = SpatialHash([pico.pos for pico in picos])
+            shards, targets = grid.pairs(pos, RCOLL)
+            # Each shard only hits the first pico it collides with.
+            first = np.full(len(pos), len(picos))
+            np.minimum.at(first, shards, targets)
+            hit = first < len(picos)
+            damages = np.bincount(first[hit], weights=power[hit],
+                                  minlength=len(picos))
+            for pico, damage in zip(picos, damages.tolist()):
+                if damage: pico.health -= damage / SHARD_LIFE / RPS
+            power[hit] = 0
+
+        self.pos[rows], self.rot[rows], self.power[rows] = pos, rot, power
+
+
 class Shard:
     """Fragment broken or shot out of a Pico, which is a regular
     octahedron whose circumscribed sphere's radius is RSHARD.
 
+    Its states are stored in a ShardPool, either the one it
+    is obtained from or a new one holding only itself.
+
     Parameters
     ----------
     address : Tuple[str, int]
@@ -67,35 +285,51 @@ class Shard:
 
     Attributes
     ----------
-    addr : Tuple[str, int]
-        IP address (host, port).
-    power : int
-        Relative destructive power.
-    space : np.ndarray of shape (12, 12, 9) of bools
-        3D array of occupied space.
-    x, y, z : floats
-        Position.
-    rot : np.ndarray of shape (3, 3) of np.float32
-        Rotational matrix.
+    pool : ShardPool
+        Storage of the shard's states.
+    index : int
+        Row of the shard in the pool.
     """
     def __init__(self, address, space, position, rotation, power=SHARD_LIFE):
-        self.addr = address
-        self.power = power
-        self.space = space
-        self.pos = position
-        self.rot = rotation
+        self.pool = ShardPool(space, capacity=1)
+        self.index = self.pool.add(address, 1, position, rotation, power)
+
+    @property
+    def addr(self) -> Tuple[str, int]:
+        """IP address (host, port)."""
+        return self.pool.owners[self.pool.owner[self.index]]
+
+    @property
+    def space(self) -> np.ndarray:
+        """3D array of occupied space."""
+        return self.pool.space
+
+    @property
+    def power(self) -> int:
+        """Relative destructive power."""
+        return int(self.pool.power[self.index])
+
+    @power.setter
+    def power(self, power):
+        self.pool.power[self.index] = power
 
     @property
     def pos(self) -> np.float32:
         """Position in a NumPy array."""
-        return np.float32([self.x, self.y, self.z])
+        return self.pool.pos[self.index].copy()
 
     @pos.setter
     def pos(self, position):
-        x, y, z = position
-        self.x = x % 12
-        self.y = y % 12
-        self.z = z % 9
+        self.pool.pos[self.index] = np.float32(position) % SIZE
+
+    @property
+    def rot(self) -> np.float32:
+        """Rotational matrix in a NumPy array."""
+        return self.pool.rot[self.index].copy()
+
+    @rot.setter
+    def rot(self, rotation):
+        self.pool.rot[self.index] = rotation
 
     @property
     def forward(self) -> np.float32:
@@ -104,25 +338,15 @@ class Shard:
 
     def should_bounce(self, x=None, y=None, z=None) -> bool:
         """Return whether it should bounce at (x, y, z)."""
-        if x is None: x = self.x
-        if y is None: y = self.y
-        if z is None: z = self.z
+        position = self.pos
+        if x is None: x = position[0]
+        if y is None: y = position[1]
+        if z is None: z = position[2]
         return not placeable(self.space, x, y, z, r=RSHARD)
 
     def update(self, fps, picos):
         """Update states."""
-        bounced = False
-        for axis, value in zip('xyz', self.pos+self.forward/fps*SHARD_SPEED):
-            if self.should_bounce(**{axis: value}):
-                self.rot = self.rot @ INV[axis]
-                bounced = True
-        self.pos += self.forward / fps * SHARD_SPEED
-        self.power -= bounced
-
-        for pico in picos:
-            if norm(pico.pos - self.pos) < RCOLL:
-                pico.health -= self.power / SHARD_LIFE / RPS
-                self.power = 0
+        self.pool.update(fps, picos, [self.index])
 
     def sync(self, position, rotation, power) -> None:
         """Synchronize states received from other peers."""
@@ -145,6 +369,8 @@ class Pico:
         Position.
     rotation : np.ndarray of shape (3, 3) of np.float32, optional
         Rotational matrix.
+    pool : ShardPool, optional
+        Storage of shards, usually shared with other picos.
 
     Attributes
     ----------
@@ -158,8 +384,11 @@ class Pico:
         Position.
     rot : np.ndarray of shape (3, 3) of np.float32
         Rotational matrix.
-    shards : Dict[int, Shard]
-        Active shards.
+    pool : ShardPool
+        Storage of shards.
+    fired : List[Tuple[int, np.ndarray, np.ndarray]]
+        ID, initial position and rotation of shards shot
+        but not yet replicated to other peers.
     recoil_u : np.ndarray of length 3 of np.float32
         Recoil direction (unit vector).
     recoil_t : float
@@ -168,10 +397,11 @@ class Pico:
         Currently rendered frames per second.
     """
     def __init__(self, address, space,
-                 health=1.0, position=None, rotation=None):
+                 health=1.0, position=None, rotation=None, pool=None):
         self.addr = address
         self.space = space
         self.health = health
+        self.pool = ShardPool(space) if pool is None else pool
 
         if position is None:
             x, y, z = random()*12, random()*12, random()*9
@@ -187,8 +417,8 @@ class Pico:
         else:
             self.rot = rotation
 
-        self.shards = {}
         self.recoil_u, self.recoil_t = np.float32([0, 0, 0]), 0.0
+        self.fired = []
         self.fps = 60.0
 
     @property
@@ -210,15 +440,20 @@ class Pico:
     def pos(self, position):
         self.x, self.y, self.z = position
 
+    @property
+    def shards(self) -> Dict[int, Shard]:
+        """Active shards, which are valid until the next collection
+        of the pool.
+        """
+        return self.pool.shards(self.addr)
+
     def sync(self, health, position, rotation, shards):
-        """Synchronize states received from other peers."""
+        """Synchronize states received from other peers,
+        where shards is a ShardTable, or None if they are
+        simulated locally from shots.
+        """
         self.health, self.pos, self.rot = health, position, rotation
-        for i, t in shards.items():
-            pos, rot, power = t
-            try:
-                self.shards[i].sync(pos, rot, power)
-            except KeyError:
-                self.shards[i] = Shard(self.addr, self.space, pos, rot, power)
+        if shards is not None: self.pool.sync(self.addr, *shards)
 
     def placeable(self, x=None, y=None, z=None) -> bool:
         """Return whether it can be placed at (x, y, z)."""
@@ -240,11 +475,17 @@ class Pico:
         # the right coordinate here, but since it works...
         self.rotate(acos(forward), atan2(upward, -right))
 
+    def heal(self, dt) -> None:
+        """Recover health point over dt seconds."""
+        self.health = min(1.0, self.health + log10(self.health+1)*dt)
+
     def update(self, right=0, upward=0, forward=0):
         """Recover health point and try to move in the given direction."""
-        if self.dead: return self.__init__(self.addr, self.space)   # respawn
+        if self.dead:   # respawn
+            self.pool.clear(self.addr)
+            return self.__init__(self.addr, self.space, pool=self.pool)
         dt = 1.0 / self.fps
-        self.health = min(1.0, self.health + log10(self.health+1)*dt)
+        self.heal(dt)
 
         direction = normalized(right, upward, forward) @ self.rot
         if self.recoil_t:
@@ -257,8 +498,9 @@ class Pico:
 
     def add_shard(self, pos, rot):
         """Add a shard at pos with rotation rot."""
-        self.shards[max(self.shards, default=0) + 1] = Shard(
-            self.addr, self.space, pos-self.recoil_u*RPICO, rot)
+        index, position = self.pool.next_id(self.addr), pos-self.recoil_u*RPICO
+        self.pool.add(self.addr, index, position, rot)
+        self.fired.append((index, position % SIZE, np.array(rot)))
 
     def shoot(self, backward=False):
         """Shoot in the forward direction unless specified otherwise."""
@@ -270,3 +512,128 @@ class Pico:
         else:
             self.recoil_u = -self.forward
             self.add_shard(self.pos, self.rot)
+
+
+class PicoArray:
+    """Batch of picos whose movements are updated at once,
+    with the same semantics as Pico.update.
+
+    Parameters
+    ----------
+    addresses : Iterable[Tuple[str, int]]
+        IP addresses (host, port).
+    space : np.ndarray of shape (12, 12, 9) of bools
+        3D array of occupied space.
+    pool : ShardPool, optional
+        Storage of shards, usually shared with other picos.
+
+    Attributes
+    ----------
+    addrs : List[Tuple[str, int]]
+        IP addresses (host, port).
+    space : np.ndarray of shape (12, 12, 9) of bools
+        3D array of occupied space.
+    pool : ShardPool
+        Storage of shards.
+    health : np.ndarray of shape (n,) of floats
+        Picos' relative health.
+    pos : np.ndarray of shape (n, 3) of np.float32
+        Positions.
+    rot : np.ndarray of shape (n, 3, 3) of np.float32
+        Rotational matrices.
+    recoil_u : np.ndarray of shape (n, 3) of np.float32
+        Recoil directions (unit vectors).
+    recoil_t : np.ndarray of shape (n,) of floats
+        Recoil time left in seconds.
+    """
+    def __init__(self, addresses, space, pool=None):
+        self.addrs = list(addresses)
+        self.space = space
+        self.pool = ShardPool(space) if pool is None else pool
+
+        n = len(self.addrs)
+        self.health = np.ones(n)
+        self.pos = np.zeros((n, 3), dtype=np.float32)
+        self.rot = np.zeros((n, 3, 3), dtype=np.float32)
+        self.recoil_u = np.zeros((n, 3), dtype=np.float32)
+        self.recoil_t = np.zeros(n)
+        self.respawn(np.ones(n, dtype=bool))
+
+    def __len__(self) -> int: return len(self.addrs)
+
+    @classmethod
+    def from_picos(cls, picos) -> 'PicoArray':
+        """Return the batch of states of the given picos,
+        which must share the same space and shard pool.
+        """
+        picos = list(picos)
+        batch = cls.__new__(cls)
+        batch.addrs = [pico.addr for pico in picos]
+        batch.space = picos[0].space if picos else None
+        batch.pool = picos[0].pool if picos else None
+        batch.health = np.float64([pico.health for pico in picos])
+        batch.pos = np.float32([pico.pos for pico in picos]).reshape(-1, 3)
+        batch.rot = np.float32([pico.rot for pico in picos]).reshape(-1, 3, 3)
+        batch.recoil_u = np.float32([pico.recoil_u
+                                     for pico in picos]).reshape(-1, 3)
+        batch.recoil_t = np.float64([pico.recoil_t for pico in picos])
+        return batch
+
+    def store(self, picos) -> None:
+        """Write states back to the given picos, in the same order."""
+        for i, pico in enumerate(picos):
+            pico.health, pico.pos = float(self.health[i]), self.pos[i]
+            pico.rot = self.rot[i].copy()
+            pico.recoil_u = self.recoil_u[i].copy()
+            pico.recoil_t = float(self.recoil_t[i])
+
+    @property
+    def dead(self) -> np.ndarray:
+        """Whether each pico is dead."""
+        return self.health < 0
+
+    @property
+    def forward(self) -> np.ndarray:
+        """Directions, as a NumPy array of shape (n, 3)."""
+        return self.rot[:, -1]
+
+    def respawn(self, mask) -> None:
+        """Respawn picos selected by the given mask of bools."""
+        for i in np.flatnonzero(mask):
+            self.pool.clear(self.addrs[i])
+            self.rot[i] = rot33(random()*pi*2, random()*pi*2) @ INVZ
+        self.health[mask] = 1.0
+        self.recoil_u[mask], self.recoil_t[mask] = 0.0, 0.0
+
+        indices = np.flatnonzero(mask)
+        while len(indices):
+            candidates = np.random.random((len(indices), 3)) * SIZE
+            placed = placeable_many(self.space, candidates, RPICO)
+            self.pos[indices[placed]] = candidates[placed]
+            indices = indices[~placed]
+
+    def update(self, intents, fps) -> None:
+        """Recover health points and try to move each pico
+        in the direction given as a row of (right, upward, forward).
+        """
+        dead, dt = self.dead, 1.0 / fps
+        self.respawn(dead)
+        alive = ~dead
+        health = self.health[alive]
+        self.health[alive] = np.minimum(1.0, health + np.log10(health+1)*dt)
+
+        intents = np.float32(intents).reshape(-1, 3)
+        lengths = norm(intents, axis=1, keepdims=True)
+        directions = np.divide(intents, lengths, where=lengths > 0,
+                               out=np.zeros_like(intents))
+        directions = np.einsum('ni,nij->nj', directions, self.rot)
+        directions += self.recoil_u * (self.recoil_t*RPS)[:, None]
+        self.recoil_t = np.maximum(self.recoil_t - dt, 0.0)
+
+        targets = self.pos + directions*dt*PICO_SPEED
+        # Axes are tried one after another, like in Pico.update.
+        for axis in range(3):
+            candidates = self.pos.copy()
+            candidates[:, axis] = targets[:, axis]
+            moved = alive & placeable_many(self.space, candidates, RPICO)
+            self.pos[moved, axis] = targets[moved, axis] % SIZE[axis]
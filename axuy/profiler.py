@@ -0,0 +1,183 @@
+# per-stage frame profiler
+# Copyright (C) 2019  Nguyễn Gia Phong
+#
+# This file is part of Axuy
+#
+# Axuy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Axuy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Axuy.  If not, see <https://www.gnu.org/licenses/>.
+
+__doc__ = 'Axuy per-stage frame profiler'
+__all__ = ['STAGES', 'Profiler']
+
+from csv import writer
+from json import dump
+from time import perf_counter
+from typing import Dict, List
+
+import numpy
+
+# Stages timed in each frame, the first of which is the whole frame
+STAGES = ('frame', 'sync', 'control', 'shards', 'push',
+          'map', 'picos', 'bloom', 'combine', 'swap')
+PROFILE_DEPTH = 4096    # frames kept for summaries and dumps
+PERCENTILES = 50, 90, 99
+
+
+class Timer:
+    """Context manager adding the time spent in it
+    to the given column of the profiler's current frame.
+    """
+
+    __slots__ = 'profiler', 'column', 'start'
+
+    def __init__(self, profiler, column) -> None:
+        self.profiler, self.column, self.start = profiler, column, 0.0
+
+    def __enter__(self) -> None:
+        self.start = perf_counter()
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.profiler.row[self.column] += perf_counter() - self.start
+
+
+class Idle:
+    """Context manager doing nothing, in place of timers
+    of a disabled profiler.
+    """
+
+    __slots__ = ()
+
+    def __enter__(self) -> None: pass
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None: pass
+
+
+IDLE = Idle()
+
+
+class Profiler:
+    """Recorder of durations of stages of recent frames
+    in a ring buffer.
+
+    Stages may be timed several times per frame, e.g. once per
+    simulation step, and their durations are summed.  Stages
+    issuing OpenGL commands are only timed on the CPU, so waiting
+    for the GPU usually shows up in the buffer swap.
+
+    Parameters
+    ----------
+    stages : Iterable[str], optional
+        Names of timed stages, the first of which is the whole frame
+        (fallback: STAGES).
+    depth : int, optional
+        Number of frames kept, 0 to disable profiling
+        (fallback: PROFILE_DEPTH).
+
+    Attributes
+    ----------
+    stages : Tuple[str, ...]
+        Names of timed stages.
+    times : numpy.ndarray of shape (depth, len(stages)) of float64s
+        Durations of stages in seconds of the recent frames,
+        wrapping around.
+    count : int
+        Number of frames started.
+    row : numpy.ndarray of float64s
+        Durations of stages of the current frame.
+    timers : Dict[str, Union[Timer, Idle]]
+        Context managers timing each stage.
+    last : float
+        Time the current frame started, in seconds
+        of an arbitrary reference.
+    """
+
+    def __init__(self, stages=STAGES, depth=PROFILE_DEPTH) -> None:
+        self.stages = tuple(stages)
+        self.times = numpy.zeros((depth, len(self.stages)))
+        self.count, self.row = 0, numpy.zeros(len(self.stages))
+        if depth:
+            self.timers = {stage: Timer(self, column)
+                           for column, stage in enumerate(self.stages)}
+        else:
+            self.timers = dict.fromkeys(self.stages, IDLE)
+        self.last = perf_counter()
+
+    @property
+    def enabled(self) -> bool:
+        """Whether frames are recorded."""
+        return len(self.times) > 0
+
+    def measure(self, stage):
+        """Return the context manager timing the given stage."""
+        return self.timers[stage]
+
+    def tick(self) -> None:
+        """Start a new frame, recording the duration of the last one
+        as the first stage.
+        """
+        if not self.enabled: return
+        now = perf_counter()
+        if self.count: self.row[0] = now - self.last
+        self.last = now
+        self.row = self.times[self.count % len(self.times)]
+        self.row.fill(0.0)
+        self.count += 1
+
+    @property
+    def frames(self) -> numpy.ndarray:
+        """Durations of stages of recorded frames, from the oldest
+        and excluding the current one, in milliseconds.
+        """
+        depth = len(self.times)
+        if self.count <= depth:
+            times = self.times[:max(self.count-1, 0)]
+        else:
+            current = (self.count-1) % depth
+            times = numpy.roll(self.times, -current-1, axis=0)[:-1]
+        return times * 1000
+
+    def percentiles(self, q=PERCENTILES) -> Dict[str, List[float]]:
+        """Return the given percentiles of durations of each stage
+        in milliseconds.
+        """
+        frames = self.frames
+        if not len(frames): return {stage: [] for stage in self.stages}
+        values = numpy.percentile(frames, q, axis=0).T.tolist()
+        return dict(zip(self.stages, values))
+
+    def summary(self, q=PERCENTILES) -> str:
+        """Return a table of the given percentiles of durations
+        of each stage in milliseconds.
+        """
+        lines = ['{:<8}'.format('ms') + ''.join(
+            '{:>9}'.format('p{:g}'.format(i)) for i in q)]
+        for stage, values in self.percentiles(q).items():
+            lines.append('{:<8}'.format(stage) + ''.join(
+                '{:9.3f}'.format(value) for value in values))
+        return '\n'.join(lines)
+
+    def dump(self, path) -> None:
+        """Write durations of recorded frames in milliseconds
+        to the given path, as JSON along with their PERCENTILES
+        if it ends with .json or as CSV otherwise.
+        """
+        frames = self.frames.tolist()
+        with open(path, 'w', newline='') as f:
+            if path.endswith('.json'):
+                dump({'stages': self.stages, 'q': PERCENTILES,
+                      'percentiles': self.percentiles(),
+                      'frames': frames}, f)
+            else:
+                csv = writer(f)
+                csv.writerow(self.stages)
+                csv.writerows(frames)
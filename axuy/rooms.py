@@ -0,0 +1,265 @@
+# multi-room host
+# Copyright (C) 2019  Nguyễn Gia Phong
+#
+# This file is part of Axuy
+#
+# Axuy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Axuy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Axuy.  If not, see <https://www.gnu.org/licenses/>.
+
+__doc__ = 'Axuy host of many rooms across worker processes'
+__all__ = ['RoomConfig', 'Room', 'RoomHost']
+
+from asyncio import new_event_loop
+from errno import EADDRINUSE
+from heapq import heappop, heappush
+from multiprocessing import Pipe, Process, cpu_count
+from signal import SIG_IGN, SIGINT, signal
+from socketserver import StreamRequestHandler, TCPServer
+from time import monotonic
+
+from .aio import AsyncPeer
+from .server import Server, ServerConfig
+
+
+class RoomConfig(ServerConfig):
+    """Room host configurations.
+
+    Host and tick rate are shared by all rooms, while the port
+    is the one of the administration interface.
+
+    Attributes
+    ----------
+    workers : int
+        Number of worker processes.
+    """
+
+    def __init__(self) -> None:
+        ServerConfig.__init__(self)
+        self.options.add_argument(
+            '-w', '--workers', type=int, metavar='N',
+            help='number of worker processes (fallback: {})'.format(
+                self.workers))
+
+    def fallback(self) -> None:
+        """Parse fallback configurations."""
+        ServerConfig.fallback(self)
+        self.port = self.config.getint('Rooms', 'Admin port')
+        self.workers = self.config.getint('Rooms', 'Workers') or cpu_count()
+
+    def read(self, arguments):
+        """Read and parse a argparse.ArgumentParser.Namespace."""
+        ServerConfig.read(self, arguments)
+        if arguments.workers is not None: self.workers = arguments.workers
+
+
+class Room(AsyncPeer, Server):
+    """Server of one match, sharing the event loop of its worker
+    with other rooms.
+
+    Parameters
+    ----------
+    config : ServerConfig
+        Server configurations.
+    loop : asyncio.AbstractEventLoop
+        Event loop of the worker.
+    """
+
+
+def work(connection) -> None:
+    """Run rooms as commanded through the given connection until
+    told to stop, each at its own tick rate.
+
+    Commands are tuples of ('open', host, port, rate), replied with
+    the port of the new room or the error raised, ('close', port),
+    replied with whether the room existed, and ('stop',).
+    """
+    signal(SIGINT, SIG_IGN)     # leave interruption to the host
+    loop = new_event_loop()
+    rooms, schedule = {}, []    # schedule is a heap of (deadline, port)
+    while True:
+        timeout = max(schedule[0][0]-monotonic(), 0) if schedule else None
+        if connection.poll(timeout):
+            command, *args = connection.recv()
+            if command == 'open':
+                host, port, rate = args
+                config = ServerConfig()
+                config.host, config.port, config.tick = host, port, rate
+                try:
+                    room = Room(config, loop)
+                except Exception as e:
+                    connection.send(e)
+                else:
+                    rooms[room.addr[1]] = room
+                    heappush(schedule, (monotonic(), room.addr[1]))
+                    connection.send(room.addr[1])
+            elif command == 'close':
+                room = rooms.pop(args[0], None)
+                if room is not None: room.__exit__(None, None, None)
+                connection.send(room is not None)
+            else:
+                break
+
+        now = monotonic()
+        while schedule and schedule[0][0] <= now:
+            deadline, port = heappop(schedule)
+            room = rooms.get(port)
+            if room is None: continue   # closed
+            room.update()
+            # Fall behind instead of catching up in a burst.
+            heappush(schedule, (max(deadline+1.0/room.tick, now), port))
+
+    for room in rooms.values(): room.__exit__(None, None, None)
+    loop.close()
+
+
+class RoomHost:
+    """Host of rooms spread across worker processes, which can be
+    opened and closed at runtime.  Each room is a server listening
+    at its own port, to which its traffic is routed.
+
+    Parameters
+    ----------
+    config : RoomConfig
+        Room host configurations.
+
+    Attributes
+    ----------
+    host : str
+        Host to bind rooms to.
+    rate : float
+        Tick rate of rooms, in updates per second.
+    workers : List[Tuple[Process, Connection]]
+        Worker processes and connections to command them.
+    rooms : Dict[int, int]
+        Indices of workers running each room, indexed by port.
+    """
+
+    def __init__(self, config):
+        self.host, self.rate = config.host, config.tick
+        self.workers, self.rooms = [], {}
+        for i in range(config.workers): self.workers.append(self.spawn())
+
+    def __enter__(self): return self
+
+    @staticmethod
+    def spawn():
+        """Start a worker and return it along with
+        the connection to command it.
+        """
+        connection, child = Pipe()
+        worker = Process(target=work, args=(child,), daemon=True)
+        worker.start()
+        return worker, connection
+
+    def command(self, index, *command):
+        """Send the command to the worker of the given index
+        and return its reply.
+
+        If the worker has died, its rooms are forgotten, it is
+        replaced by a new one and ConnectionError is raised.
+        """
+        worker, connection = self.workers[index]
+        try:
+            connection.send(command)
+            return connection.recv()
+        except (EOFError, OSError):
+            self.rooms = {port: i for port, i in self.rooms.items()
+                          if i != index}
+            connection.close()
+            worker.join()
+            self.workers[index] = self.spawn()
+            raise ConnectionError('worker {} died'.format(index))
+
+    def open(self, port=0, rate=None) -> int:
+        """Open a room at the given port (fallback: any free one)
+        and return its port.
+
+        The room is run by the worker with the least rooms.
+        Raise ValueError if the port or rate is invalid.
+        """
+        if not 0 <= port < 1 << 16: raise ValueError('invalid port')
+        if rate is not None and not 0 < rate < float('inf'):
+            raise ValueError('invalid rate')
+        if port in self.rooms:
+            raise OSError(EADDRINUSE, 'room already open at this port')
+        load = [0] * len(self.workers)
+        for index in self.rooms.values(): load[index] += 1
+        index = load.index(min(load))
+        reply = self.command(index, 'open', self.host, port,
+                             rate or self.rate)
+        if isinstance(reply, Exception): raise reply
+        self.rooms[reply] = index
+        return reply
+
+    def close(self, port) -> None:
+        """Close the room at the given port.
+
+        Raise KeyError if there is no such room.
+        """
+        self.command(self.rooms.pop(port), 'close', port)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for worker, connection in self.workers:
+            try:
+                connection.send(('stop',))
+            except OSError:     # already dead
+                pass
+        for worker, connection in self.workers: worker.join()
+
+
+class AdminHandler(StreamRequestHandler):
+    """Handler of line-based administration commands:
+    'open [PORT [RATE]]', 'close PORT' and 'list'.
+    """
+
+    def handle(self) -> None:
+        host = self.server.host
+        for line in self.rfile:
+            command, *args = line.decode().split() or ['']
+            try:
+                if command == 'open':
+                    reply = host.open(*map(int, args[:1]),
+                                      *map(float, args[1:2]))
+                elif command == 'close':
+                    host.close(int(args[0]))
+                    reply = 'closed'
+                elif command == 'list':
+                    reply = ' '.join(map(str, sorted(host.rooms)))
+                else:
+                    reply = 'error: unknown command'
+            except (IndexError, KeyError, OSError, ValueError) as e:
+                reply = 'error: {!r}'.format(e)
+            self.wfile.write('{}\n'.format(reply).encode())
+
+
+class AdminServer(TCPServer):
+    """Server of the administration interface."""
+    allow_reuse_address = True
+
+
+def main():
+    """Parse arguments and start the room host."""
+    config = RoomConfig()
+    config.parse()
+    with RoomHost(config) as host, AdminServer(
+            (config.host, config.port), AdminHandler) as admin:
+        admin.host = host
+        print('Axuy rooms are administered at {}:{}'.format(
+            *admin.server_address))
+        try:
+            admin.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__': main()
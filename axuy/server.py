@@ -0,0 +1,163 @@
+# headless authoritative server
+# Copyright (C) 2019  Nguyễn Gia Phong
+#
+# This file is part of Axuy
+#
+# Axuy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Axuy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Axuy.  If not, see <https://www.gnu.org/licenses/>.
+
+__doc__ = 'Axuy headless authoritative server'
+__all__ = ['ServerConfig', 'Server']
+
+from threading import Thread
+from time import monotonic, sleep
+from typing import Dict, Tuple
+
+from .peer import Peer, PeerConfig
+from .wire import State
+
+
+class ServerConfig(PeerConfig):
+    """Server configurations.
+
+    The topology is always star, with the server as the relay.
+    """
+
+    def fallback(self) -> None:
+        """Parse fallback configurations."""
+        PeerConfig.fallback(self)
+        self.topology = 'star'
+
+    def read(self, arguments):
+        """Read and parse a argparse.ArgumentParser.Namespace."""
+        PeerConfig.read(self, arguments)
+        self.topology = 'star'
+
+
+class Server(Peer):
+    """Spectating peer simulating at a fixed tick rate, relaying
+    states of all others at its send rate and resolving hits
+    on its own, so that its health of every pico is authoritative.
+
+    Peers should join it in star topology.
+
+    Parameters
+    ----------
+    config : ServerConfig
+        Server configurations.
+
+    Attributes
+    ----------
+    running : bool
+        Whether the server is running.
+    killed : Dict[Tuple[str, int], int]
+        Sequence numbers of the first states pushed since the server
+        killed each pico, which its peer must acknowledge before
+        its reported health is taken again.
+    """
+
+    def __init__(self, config):
+        Peer.__init__(self, config)
+        self.running, self.killed = True, {}
+        # The protagonist is kept only to hold the loop rate.
+        del self.picos[self.addr]
+
+    @property
+    def is_running(self) -> bool:
+        """Server status."""
+        return self.running
+
+    def get_time(self) -> float:
+        """Return the current time in seconds."""
+        return monotonic()
+
+    def sync(self) -> None:
+        """Synchronize states received from other peers,
+        except for health of picos that are alive or killed
+        without their peers knowing yet.
+        """
+        health = {addr: pico.health for addr, pico in self.picos.items()}
+        Peer.sync(self)
+        for addr, value in health.items():
+            # Reported health is only taken on respawn,
+            # once the peer knows of the death.
+            if value >= 0 or addr in self.killed:
+                self.picos[addr].health = value
+
+    def buffer(self, address, state) -> None:
+        """Store the snapshot received from the given address
+        to be played later, noting if it was sent after
+        the death of its pico was acknowledged.
+        """
+        if state.ack >= self.killed.get(address, float('inf')):
+            del self.killed[address]
+        Peer.buffer(self, address, state)
+
+    def step(self) -> None:
+        """Advance the simulation by a fixed step, noting picos
+        killed by the server so that they stay dead until
+        their peers learn of it, even if corrections are lost.
+        """
+        alive = [addr for addr, pico in self.picos.items() if not pico.dead]
+        Peer.step(self)
+        for addr in alive:
+            if self.picos[addr].dead: self.killed[addr] = self.seq + 1
+
+    def control(self) -> None:
+        """Recover health of all picos."""
+        for pico in self.picos.values(): pico.heal(1.0 / self.tick)
+
+    def snapshot(self) -> State:
+        """Return the snapshot of a spectator."""
+        return State(self.seq, 0.0, None, None, None)
+
+    def relayed_to(self, peer, relayed) -> Dict[Tuple[str, int], State]:
+        """Return snapshots to be relayed to the given peer
+        among the given ones, with authoritative health,
+        plus a snapshot carrying the peer's own health.
+        """
+        snapshots = {addr: state._replace(health=self.picos[addr].health)
+                     for addr, state in Peer.relayed_to(
+                         self, peer, relayed).items()}
+        if peer in self.picos:
+            snapshots[peer] = State(self.received.get(peer, 0),
+                                    self.picos[peer].health, None, None, None)
+        return snapshots
+
+    def run(self) -> None:
+        """Start main loop, updating once per tick."""
+        Thread(target=self.serve, daemon=True).start()
+        Thread(target=self.pull, daemon=True).start()
+        period, deadline = 1.0 / self.tick, self.get_time()
+        while self.is_running:
+            self.update()
+            deadline += period
+            delay = deadline - self.get_time()
+            if delay > 0:
+                sleep(delay)
+            else:   # fall behind instead of catching up in a burst
+                deadline = self.get_time()
+
+
+def main():
+    """Parse arguments and start the server."""
+    config = ServerConfig()
+    config.parse()
+    with Server(config) as server:
+        try:
+            server.run()
+        except KeyboardInterrupt:
+            server.running = False
+
+
+if __name__ == '__main__': main()
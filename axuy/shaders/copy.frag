@@ -0,0 +1,10 @@
+#version 330
+
+uniform sampler2D tex;
+
+in vec2 in_text;
+
+void main(void)
+{
+	gl_FragColor = texture(tex, in_text);
+}
@@ -0,0 +1,21 @@
+#version 330
+
+uniform float visibility;
+uniform vec3 camera;
+uniform mat4 vp;
+
+in vec3 in_vert;
+in vec3 in_pos;
+in mat3 in_rot;
+in vec3 in_color;
+out float intensity;
+out vec3 color;
+
+void main()
+{
+	vec3 vert = in_rot * in_vert + in_pos;
+	float dist = distance(camera, vert);
+	intensity = 1 / (1 + dist * dist / visibility);
+	color = in_color;
+	gl_Position = vp * vec4(vert, 1.0);
+}
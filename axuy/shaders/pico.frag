@@ -1,8 +1,7 @@
 #version 330
 
-uniform vec3 color;
-
 in float intensity;
+in vec3 color;
 
 void main()
 {
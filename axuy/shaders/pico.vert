@@ -2,10 +2,13 @@
 
 uniform vec3 pos;
 uniform mat4 rot;
+uniform vec3 color;
 
 in vec4 in_vert;
+out vec3 tint;
 
 void main()
 {
 	gl_Position = rot * in_vert + vec4(pos, 0.0);
+	tint = color;
 }
@@ -0,0 +1,348 @@
+# binary wire format
+# Copyright (C) 2019  Nguyễn Gia Phong
+#
+# This file is part of Axuy
+#
+# Axuy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Axuy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Axuy.  If not, see <https://www.gnu.org/licenses/>.
+
+__doc__ = 'Axuy binary wire format'
+__all__ = ['MAGIC', 'VERSION', 'HISTORY', 'HEADER', 'ROW', 'ShotTable',
+           'State', 'pack_rotations', 'unpack_rotations', 'encode_state',
+           'decode_state', 'diff', 'patch', 'encode_batches',
+           'decode_batch', 'encode_handshake', 'decode_handshake',
+           'is_batch', 'is_pickle']
+
+from struct import Struct, error as struct_error
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from .pico import ShardTable
+
+MAGIC = b'AX'
+VERSION = 5
+STATE = 1   # packet kind
+BATCH = 2   # packet kind
+HANDSHAKE = 3   # packet kind
+PICO = 1    # flag for the presence of the pico row
+SHARDS = 2  # flag for the presence of the shard table
+HISTORY = 32    # number of snapshots kept for delta compression
+PICKLE_PROTO = 0x80     # first byte of pickles of protocol 2 and above
+QUANTUM = 32767     # scale of quantized rotations
+MTU = 1472  # largest batch fitting an Ethernet frame without fragmentation
+
+# Fixed header: magic, version, kind, sequence number, acknowledged
+# sequence number, baseline sequence number (0 for full snapshots),
+# sender's time, maximum rate wanted by the sender, health, flags,
+# number of shard rows, number of shots and number of removed shards.
+HEADER = Struct('<2sBBIIIdHfBHHH')
+# The pico itself is the first row if it has changed, followed by
+# its changed shards and its shots, then ages of shots as float32
+# and IDs of removed shards as uint32.
+# Rotations are sent as their last two rows quantized to int16,
+# plus whether they are left-handed to recover the first row.
+ROW = np.dtype([('id', '<u4'), ('pos', '<f4', 3), ('rot', '<i2', 6),
+                ('left', 'u1'), ('power', 'i1')])
+NOTHING = np.zeros(0, dtype=np.int64)
+# Batches of packets relayed on behalf of other peers start with
+# magic, version, kind and number of packets, each of which is
+# preceded by the length of its origin's host, the origin's port
+# and the length of the packet, followed by the host.
+BATCH_HEADER = Struct('<2sBBH')
+ENTRY = Struct('<BHH')
+# Handshakes sent by peers to those joining start with magic, version,
+# kind, number of map building blocks and number of connected peers,
+# followed by the map ID as bytes and the peers, each of which
+# is the length of its host and its port followed by the host.
+HANDSHAKE_HEADER = Struct('<2sBBHH')
+PEER = Struct('<BH')
+
+
+class ShotTable(NamedTuple):
+    """Shots fired by a pico, as parallel arrays of shard IDs,
+    time since fired, initial positions and rotations.
+    """
+    ids: np.ndarray
+    age: np.ndarray
+    pos: np.ndarray
+    rot: np.ndarray
+
+
+NOSHARD = ShardTable(NOTHING, np.zeros((0, 3), dtype=np.float32),
+                     np.zeros((0, 3, 3), dtype=np.float32), NOTHING)
+NOSHOT = ShotTable(NOTHING, np.zeros(0, dtype=np.float32),
+                   np.zeros((0, 3), dtype=np.float32),
+                   np.zeros((0, 3, 3), dtype=np.float32))
+
+
+class State(NamedTuple):
+    """Instantaneous state of a pico and its shards.
+
+    A delta against the snapshot numbered base has pos and rot
+    set to None if they are unchanged, only changed shards and
+    IDs of shards removed since the baseline.  Full snapshots
+    without pos and rot come from spectators, which have no pico,
+    or only carry the health of the receiver's own pico.  Shards
+    are None if they are simulated by receivers from shots, which
+    are not part of the snapshot but events carried along with it.
+    The time is when the snapshot was taken by the sender's clock
+    and the rate is the most states per second the sender wants
+    to receive, or 0 for no limit.
+    """
+    seq: int
+    health: float
+    pos: Optional[np.ndarray]
+    rot: Optional[np.ndarray]
+    shards: Optional[ShardTable]
+    ack: int = 0
+    base: int = 0
+    removed: np.ndarray = NOTHING
+    shots: ShotTable = NOSHOT
+    time: float = 0.0
+    rate: int = 0
+
+
+def pack_rotations(rotations, rows) -> None:
+    """Write the given orthonormal matrices into rows of dtype ROW."""
+    rotations = np.reshape(rotations, (-1, 3, 3))
+    rows['rot'] = np.rint(rotations[:, 1:].reshape(-1, 6) * QUANTUM)
+    rows['left'] = np.linalg.det(rotations) < 0
+
+
+def unpack_rotations(rows) -> np.ndarray:
+    """Return the matrices of float32 stored in rows of dtype ROW."""
+    rotations = np.empty((len(rows), 3, 3), dtype=np.float32)
+    np.multiply(rows['rot'].reshape(-1, 2, 3), 1/QUANTUM,
+                out=rotations[:, 1:], casting='unsafe')
+    # The first row is the cross product of the others,
+    # negated for left-handed matrices.
+    (bx, by, bz), (cx, cy, cz) = rotations[:, 1].T, rotations[:, 2].T
+    sign = 1 - rows['left']*2.0
+    rotations[:, 0, 0] = (by*cz - bz*cy) * sign
+    rotations[:, 0, 1] = (bz*cx - bx*cz) * sign
+    rotations[:, 0, 2] = (bx*cy - by*cx) * sign
+    return rotations
+
+
+def encode_state(state) -> bytes:
+    """Return the state packet of the given State."""
+    present = PICO if state.pos is not None else 0
+    shards = NOSHARD if state.shards is None else state.shards
+    flags = present if state.shards is None else present | SHARDS
+    count, shots = len(shards.ids), len(state.shots.ids)
+    removed = np.asarray(state.removed, dtype='<u4')
+    rows = np.zeros(present + count + shots, dtype=ROW)
+    rows['id'][present:] = np.concatenate([shards.ids, state.shots.ids])
+    rows['power'][present:present+count] = shards.power
+    positions = [np.reshape(shards.pos, (-1, 3)),
+                 np.reshape(state.shots.pos, (-1, 3))]
+    rotations = [np.reshape(shards.rot, (-1, 3, 3)),
+                 np.reshape(state.shots.rot, (-1, 3, 3))]
+    if present:
+        positions.insert(0, np.reshape(state.pos, (1, 3)))
+        rotations.insert(0, np.reshape(state.rot, (1, 3, 3)))
+    rows['pos'] = np.concatenate(positions)
+    pack_rotations(np.concatenate(rotations), rows)
+    header = HEADER.pack(MAGIC, VERSION, STATE, state.seq, state.ack,
+                         state.base, state.time, state.rate,
+                         state.health, flags,
+                         count, shots, len(removed))
+    ages = np.asarray(state.shots.age, dtype='<f4')
+    return header + rows.tobytes() + ages.tobytes() + removed.tobytes()
+
+
+def decode_state(data) -> State:
+    """Return the state stored in the given packet, which may be
+    any bytes-like object, e.g. a memoryview of a reused buffer,
+    as the returned arrays do not share memory with it.
+
+    Raise ValueError if the packet is invalid or of an unsupported version.
+    """
+    try:
+        (magic, version, kind, seq, ack, base, time, rate, health,
+         flags, count, shots, removed) = HEADER.unpack_from(data)
+    except struct_error:
+        raise ValueError('truncated packet')
+    if magic != MAGIC: raise ValueError('unrecognized packet')
+    if version != VERSION:
+        raise ValueError('unsupported version {}'.format(version))
+    if kind != STATE: raise ValueError('unknown packet kind')
+    present = flags & PICO
+    n, end = present + count, present + count + shots
+    offset = HEADER.size + end*ROW.itemsize
+    if len(data) != offset + shots*4 + removed*4:
+        raise ValueError('table size mismatch')
+
+    rows = np.frombuffer(data, dtype=ROW, count=end, offset=HEADER.size)
+    rotations, positions = unpack_rotations(rows), rows['pos'].copy()
+    ids = rows['id'].astype(np.int64)
+    shards = ShardTable(ids[present:n], positions[present:n],
+                        rotations[present:n],
+                        rows['power'][present:n].astype(np.int32))
+    if not flags & SHARDS: shards = None
+    ages = np.frombuffer(data, dtype='<f4', count=shots, offset=offset)
+    fired = ShotTable(ids[n:], ages.astype(np.float32),
+                      positions[n:], rotations[n:])
+    removed = np.frombuffer(data, dtype='<u4', count=removed,
+                            offset=offset+shots*4)
+    return State(seq, health, positions[0] if present else None,
+                 rotations[0] if present else None, shards,
+                 ack, base, removed.astype(np.int64), fired, time, rate)
+
+
+def match(ids, reference) -> Tuple[np.ndarray, np.ndarray]:
+    """Return whether each of ids is in reference and its index there."""
+    ids, reference = np.asarray(ids), np.asarray(reference)
+    order = np.argsort(reference)
+    ranks = np.searchsorted(reference, ids, sorter=order)
+    exist = ranks < len(reference)
+    found = np.zeros(len(ids), dtype=int)
+    found[exist] = order[ranks[exist]]
+    exist[exist] = reference[found[exist]] == ids[exist]
+    return exist, found
+
+
+def diff(state, baseline) -> State:
+    """Return the delta of a full snapshot against another."""
+    unchanged = (np.array_equal(state.pos, baseline.pos)
+                 and np.array_equal(state.rot, baseline.rot))
+    if state.shards is None or baseline.shards is None:
+        return state._replace(
+            pos=None if unchanged else state.pos,
+            rot=None if unchanged else state.rot, base=baseline.seq)
+    ids, previous = state.shards.ids, baseline.shards
+    exist, found = match(ids, previous.ids)
+    changed = ~exist
+    for now, then in zip(state.shards[1:], previous[1:]):
+        then = then[found[exist]]
+        axes = tuple(range(1, then.ndim))
+        changed[exist] |= np.any(now[exist] != then, axis=axes)
+    removed = previous.ids[~match(previous.ids, ids)[0]]
+    return state._replace(
+        pos=None if unchanged else state.pos,
+        rot=None if unchanged else state.rot,
+        shards=ShardTable(*(array[changed] for array in state.shards)),
+        base=baseline.seq, removed=removed)
+
+
+def patch(baseline, delta) -> State:
+    """Return the full snapshot of a delta against the given baseline."""
+    previous, shards = baseline.shards, delta.shards
+    if previous is not None and shards is not None:
+        outdated = np.concatenate([delta.removed, shards.ids])
+        kept = ~match(previous.ids, outdated)[0]
+        shards = ShardTable(*(np.concatenate([then[kept], now])
+                              for now, then in zip(shards, previous)))
+    return delta._replace(
+        pos=baseline.pos if delta.pos is None else delta.pos,
+        rot=baseline.rot if delta.rot is None else delta.rot,
+        shards=shards, base=0, removed=NOTHING)
+
+
+def encode_batches(packets: Iterable[Tuple[bytes, Tuple[str, int]]],
+                   limit=MTU) -> Iterator[bytes]:
+    """Return an iterator of batches of the given (packet, origin),
+    each of which is no larger than limit unless it only has one packet.
+    """
+    def batch(entries):
+        header = BATCH_HEADER.pack(MAGIC, VERSION, BATCH, len(entries))
+        return header + b''.join(entries)
+
+    entries, size = [], BATCH_HEADER.size
+    for packet, (host, port) in packets:
+        host = host.encode()
+        entry = ENTRY.pack(len(host), port, len(packet)) + host + packet
+        if entries and size+len(entry) > limit:
+            yield batch(entries)
+            entries, size = [], BATCH_HEADER.size
+        entries.append(entry)
+        size += len(entry)
+    if entries: yield batch(entries)
+
+
+def decode_batch(data) -> List[Tuple[memoryview, Tuple[str, int]]]:
+    """Return the list of (packet, origin) stored in the given batch,
+    where packets are views of its memory.
+
+    Raise ValueError if the batch is invalid.
+    """
+    data = memoryview(data)
+    try:
+        magic, version, kind, count = BATCH_HEADER.unpack_from(data)
+        offset, packets = BATCH_HEADER.size, []
+        for i in range(count):
+            length, port, size = ENTRY.unpack_from(data, offset)
+            offset += ENTRY.size
+            host = bytes(data[offset:offset+length]).decode()
+            offset += length
+            packets.append((data[offset:offset+size], (host, port)))
+            offset += size
+    except (struct_error, UnicodeDecodeError):
+        raise ValueError('truncated batch')
+    if version != VERSION:
+        raise ValueError('unsupported version {}'.format(version))
+    if offset != len(data): raise ValueError('batch size mismatch')
+    return packets
+
+
+def encode_handshake(mapid, peers) -> bytes:
+    """Return the handshake carrying the given map ID
+    and addresses of connected peers.
+    """
+    entries = []
+    for host, port in peers:
+        host = host.encode()
+        entries.append(PEER.pack(len(host), port) + host)
+    return (HANDSHAKE_HEADER.pack(MAGIC, VERSION, HANDSHAKE,
+                                  len(mapid), len(peers))
+            + bytes(mapid) + b''.join(entries))
+
+
+def decode_handshake(data) -> Tuple[List[int], List[Tuple[str, int]]]:
+    """Return the map ID and addresses of connected peers
+    stored in the given handshake.
+
+    Raise ValueError if the handshake is invalid.
+    """
+    try:
+        magic, version, kind, blocks, count = HANDSHAKE_HEADER.unpack_from(
+            data)
+        offset = HANDSHAKE_HEADER.size + blocks
+        mapid, peers = list(data[HANDSHAKE_HEADER.size:offset]), []
+        for i in range(count):
+            length, port = PEER.unpack_from(data, offset)
+            offset += PEER.size
+            host = bytes(data[offset:offset+length]).decode()
+            offset += length
+            peers.append((host, port))
+    except (struct_error, UnicodeDecodeError):
+        raise ValueError('truncated handshake')
+    if magic != MAGIC: raise ValueError('unrecognized handshake')
+    if version != VERSION:
+        raise ValueError('unsupported version {}'.format(version))
+    if kind != HANDSHAKE: raise ValueError('unknown packet kind')
+    if offset != len(data): raise ValueError('handshake size mismatch')
+    return mapid, peers
+
+
+def is_batch(data) -> bool:
+    """Return whether the packet is a batch of relayed packets."""
+    return data[:2] == MAGIC and data[3:4] == bytes([BATCH])
+
+
+def is_pickle(data) -> bool:
+    """Return whether the packet seems to be sent by a peer
+    still using the legacy pickle format.
+    """
+    return len(data) > 0 and data[0] == PICKLE_PROTO